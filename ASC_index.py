@@ -0,0 +1,189 @@
+"""
+Author: Jens Segaert
+Company: VDL Bus Roeselare
+
+Python version: 3.11.5
+
+Description: Sidecar index for ASC log files (can_log_*.asc -> can_log_*.asc.idx).
+The log is divided in buckets of index_bucket_seconds. The index has the byte offset where each bucket starts and, for every
+arbitration ID, a bitmap of the buckets that contain it. Tools can then seek to a time range or an ID instead of reading the whole log.
+The log writer of ASC_logger fills the index while logging. For older logs, build the index afterwards:
+python ASC_index.py "Log files\\can_log_....asc"
+
+Bucket k is the part of the file from offsets[k] to offsets[k + 1]. Its lines have a timestamp below (k + 1) * index_bucket_seconds.
+A line that is logged late (older timestamp than the line before it) stays in the bucket where it is written, so a bucket can also
+have older lines. Normally these are at most one bucket late; the index keeps how many buckets the latest line was late
+(late_buckets), and find_buckets() reads that many buckets more.
+"""
+
+import argparse
+import base64
+import glob
+import json
+import os
+
+
+
+index_version = 1
+index_bucket_seconds = 1.0  # Time per bucket in seconds
+index_suffix = '.idx'
+
+
+
+# Function to make a new, empty index
+def new_index(bucket_seconds=index_bucket_seconds):
+    return {'bucket_seconds': bucket_seconds, 'offsets': [], 'id_buckets': {}, 'late_buckets': 1}
+
+
+
+# Function to add a logged line to the index: its timestamp (seconds), arbitration ID and the byte offset where the line starts
+def add_line(index, timestamp, arbitration_id, offset):
+    offsets = index['offsets']
+
+    # A new bucket starts at the first line with a later time
+    bucket = max(int(timestamp / index['bucket_seconds']), 0)
+    while len(offsets) <= bucket:
+        offsets.append(offset)
+
+    # A late line is written in the current bucket
+    if len(offsets) - 1 - bucket > index['late_buckets']:
+        index['late_buckets'] = len(offsets) - 1 - bucket
+    bucket = len(offsets) - 1
+
+    id_bitmap = index['id_buckets'].get(arbitration_id)
+    if id_bitmap is None:
+        id_bitmap = bytearray()
+        index['id_buckets'][arbitration_id] = id_bitmap
+    if len(id_bitmap) <= bucket // 8:
+        id_bitmap.extend(bytes(bucket // 8 + 1 - len(id_bitmap)))
+    id_bitmap[bucket // 8] |= 1 << (bucket % 8)
+
+
+
+# Function to get the path of the index of a log file
+def get_index_path(log_path):
+    return log_path + index_suffix
+
+
+
+# Function to write the index next to the log file. log_size is the number of bytes of the log that are in the index.
+# A temporary file is written first, so an interrupted write never leaves a broken index.
+def write_index(index, log_path, log_size):
+    index_data = {
+        'version': index_version,
+        'log_size': log_size,
+        'bucket_seconds': index['bucket_seconds'],
+        'offsets': index['offsets'],
+        'late_buckets': index['late_buckets'],
+        'ids': {f'{arbitration_id:X}': base64.b64encode(bytes(id_bitmap)).decode('ascii') for arbitration_id, id_bitmap in index['id_buckets'].items()}
+    }
+
+    index_path = get_index_path(log_path)
+    temporary_path = index_path + '.tmp'
+    with open(temporary_path, 'w') as index_file:
+        json.dump(index_data, index_file, separators=(',', ':'))
+    os.replace(temporary_path, index_path)
+
+
+
+# Function to read the index of a log file. Returns None if there is no (valid) index.
+def read_index(log_path):
+    try:
+        with open(get_index_path(log_path), 'r') as index_file:
+            index_data = json.load(index_file)
+    except (OSError, ValueError):
+        return None
+
+    if index_data.get('version') != index_version:
+        return None
+
+    return {
+        'bucket_seconds': index_data['bucket_seconds'],
+        'offsets': index_data['offsets'],
+        'late_buckets': index_data.get('late_buckets', 1),
+        'id_buckets': {int(arbitration_id, 16): bytearray(base64.b64decode(id_bitmap)) for arbitration_id, id_bitmap in index_data['ids'].items()},
+        'log_size': index_data['log_size']
+    }
+
+
+
+# Function to read the timestamp and arbitration ID of a line of an ASC log, e.g. b'   0.024188 1  18FFB331x       Rx   d 8 81 ...'.
+# Returns None for lines that are not CAN-frames (header, events, error frames).
+def parse_log_line(line):
+    fields = line.split(None, 4)
+    if len(fields) < 5 or not fields[1].isdigit() or fields[3] not in (b'Rx', b'Tx'):
+        return None
+
+    try:
+        return float(fields[0]), int(fields[2].rstrip(b'xX'), 16)
+    except ValueError:
+        return None
+
+
+
+# Function to build the index of an existing log file by reading it once
+def build_index(log_path, bucket_seconds=index_bucket_seconds):
+    index = new_index(bucket_seconds)
+    offset = 0
+
+    with open(log_path, 'rb') as log_file:
+        for line in log_file:
+            parsed_line = parse_log_line(line)
+            if parsed_line is not None:
+                add_line(index, parsed_line[0], parsed_line[1], offset)
+            offset += len(line)
+
+    write_index(index, log_path, offset)
+    return index, offset
+
+
+
+# Function to get the buckets of a time range (seconds) and/or arbitration ID. None means no limit.
+def find_buckets(index, start_time=None, end_time=None, arbitration_id=None):
+    number_of_buckets = len(index['offsets'])
+    first_bucket = 0 if start_time is None else max(int(start_time / index['bucket_seconds']), 0)
+    # A late line can be written in a later bucket (at most late_buckets later), so these buckets are read too
+    last_bucket = number_of_buckets - 1 if end_time is None else min(int(end_time / index['bucket_seconds']) + index['late_buckets'], number_of_buckets - 1)
+
+    if arbitration_id is None:
+        return list(range(first_bucket, last_bucket + 1))
+
+    id_bitmap = index['id_buckets'].get(arbitration_id, b'')
+    return [bucket for bucket in range(first_bucket, min(last_bucket + 1, len(id_bitmap) * 8)) if id_bitmap[bucket // 8] >> (bucket % 8) & 1]
+
+
+
+# Function to get the byte ranges (start, end) of the log that hold the given buckets. Following buckets are merged into one range.
+# The last bucket ends at log_size; the part of the log after log_size is not in the index and is not included.
+def get_byte_ranges(index, buckets, log_size):
+    offsets = index['offsets']
+    byte_ranges = []
+
+    for bucket in buckets:
+        start_offset = offsets[bucket]
+        end_offset = offsets[bucket + 1] if bucket + 1 < len(offsets) else log_size
+        if byte_ranges and byte_ranges[-1][1] == start_offset:
+            byte_ranges[-1] = (byte_ranges[-1][0], end_offset)
+        elif end_offset > start_offset:
+            byte_ranges.append((start_offset, end_offset))
+
+    return byte_ranges
+
+
+
+# Main function: build the index of log files afterwards
+def main():
+    parser = argparse.ArgumentParser(description="Build the sidecar index (.idx) of ASC log files.")
+    parser.add_argument("log_files", nargs="+", help="ASC log files (wildcards allowed)")
+    parser.add_argument("--bucket-seconds", type=float, default=index_bucket_seconds, help=f"time per bucket in seconds (default: {index_bucket_seconds})")
+    arguments = parser.parse_args()
+
+    for log_pattern in arguments.log_files:
+        for log_path in glob.glob(log_pattern) or [log_pattern]:
+            index, log_size = build_index(log_path, arguments.bucket_seconds)
+            print(f'{get_index_path(log_path)}: {len(index["offsets"])} buckets, {len(index["id_buckets"])} IDs, {log_size} bytes')
+
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,276 @@
+"""
+Author: Jens Segaert
+Company: VDL Bus Roeselare
+
+Python version: 3.11.5
+
+Description: Log writer for the CAN-messages of Main and CAN-viewer.
+The receive threads only put messages in a bounded queue. A separate thread formats them in batches
+and writes them to the log file (vector CANalyzer 9.0 format), so slow disk I/O never blocks CAN reception.
+If the queue is full, the message is dropped and counted. A message that can not be written is counted as an error,
+the log writer keeps running.
+While logging, the sidecar index of the log (see ASC_index) is kept up to date.
+"""
+
+import os
+import queue
+import time
+import timeit
+import can
+from threading import Thread, Lock
+import Instrumentation
+import ASC_index
+
+
+
+log_file = None
+start_time_logger = None
+log_writer_thread = None
+
+log_queue_size = 100000  # Maximum number of messages waiting to be written
+log_batch_size = 1000  # Maximum number of messages formatted and written at once
+log_flush_size = 64 * 1024  # Flush the log file after this many characters
+log_flush_interval = 1.0  # Flush the log file at least every second
+index_write_interval = 60.0  # Write the index of the log file at least every minute (and when the log writer stops)
+
+log_queue = queue.Queue(maxsize=log_queue_size)
+
+max_log_timestamp = 1e7  # Larger times (in seconds) mean the driver does not use the time since epoch
+min_log_timestamp = -1.0  # Frames the driver received up to this long before the start are logged at 0.0
+
+# Cached parts of log lines per (channel, ID, DLC) and clock offsets of drivers per channel
+log_line_middles = {}
+clock_offsets = {}
+
+# Channel numbers in the log of drivers that name their channels (e.g. 'PCAN_USBBUS1' or 'can0'), in order of the first message
+log_channel_numbers = {}
+
+# Index of the log file and the byte offset of the next line. A '\n' is written as os.linesep (log files are opened in text mode).
+log_index = None
+log_offset = 0
+newline_size = len(os.linesep)
+
+# Counters of the log writer
+log_counters = {'queued': 0, 'written': 0, 'dropped': 0, 'errors': 0}
+log_counters_lock = Lock()
+
+
+
+# Function to get the time of a message in seconds after the start of the measurement.
+# The receive timestamp of the driver is used, so the time a message waited in the queue does not matter.
+# A frame the driver buffered just before the start gets time 0.0, so it stays in order.
+# A driver with its own clock (not the time since epoch) is aligned once on its first message.
+def get_log_timestamp(message, start_time_logger):
+    timestamp = message.timestamp - start_time_logger
+    if 0.0 <= timestamp < max_log_timestamp:
+        return timestamp
+    if min_log_timestamp < timestamp < 0.0:
+        return 0.0
+
+    clock_offset = clock_offsets.get(message.channel)
+    if clock_offset is None:
+        clock_offset = message.timestamp - (time.time() - start_time_logger)
+        clock_offsets[message.channel] = clock_offset
+
+    return message.timestamp - clock_offset
+
+
+
+# Function to get the channel number of a message in the log file (starting at 1).
+# Channel indexes (int) count from 0, channel names get the next free number.
+def get_log_channel_number(channel):
+    if isinstance(channel, int):
+        return channel + 1
+
+    if channel not in log_channel_numbers:
+        log_channel_numbers[channel] = len(log_channel_numbers) + 1
+    return log_channel_numbers[channel]
+
+
+
+# Function to format message to put in logger file.
+# The part of the line between timestamp and data only depends on channel, ID and DLC, so it is made once and reused.
+def format_message_for_log_file(message, start_time_logger):
+    line_key = (message.channel, message.arbitration_id, message.dlc)
+    line_middle = log_line_middles.get(line_key)
+    if line_middle is None:
+        message_channel = get_log_channel_number(message.channel)
+        ID_for_log_file = f'{message.arbitration_id:08X}x'
+        line_middle = f" {message_channel}  {ID_for_log_file}       Rx   d {message.dlc} "
+        log_line_middles[line_key] = line_middle
+
+    return f"{get_log_timestamp(message, start_time_logger):.6f}{line_middle}{message.data.hex(' ').upper()}"
+
+
+
+# Function to put a message in the queue of the log writer. If the queue is full, the message is dropped.
+def write_message_to_log_file(message):
+    try:
+        log_queue.put_nowait(message)
+        counter_name = 'queued'
+    except queue.Full:
+        counter_name = 'dropped'
+
+    with log_counters_lock:
+        log_counters[counter_name] += 1
+
+
+
+# Function to add the lines of a batch to the index of the log file
+def add_batch_to_index(batch, lines):
+    global log_offset
+
+    for message, line in zip(batch, lines):
+        ASC_index.add_line(log_index, get_log_timestamp(message, start_time_logger), message.arbitration_id, log_offset)
+        log_offset += len(line) + newline_size - 1
+
+
+
+# Function to format the lines of a batch. A message that can not be formatted is left out and counted as an error.
+def format_batch(batch):
+    try:
+        return batch, [f"   {format_message_for_log_file(message, start_time_logger)} \n" for message in batch]
+    except Exception:
+        pass
+
+    # Format the messages one by one to find the ones that fail
+    good_messages = []
+    lines = []
+    for message in batch:
+        try:
+            lines.append(f"   {format_message_for_log_file(message, start_time_logger)} \n")
+            good_messages.append(message)
+        except Exception as e:
+            with log_counters_lock:
+                log_counters['errors'] += 1
+            print(f'Log writer: message not written: {e}')
+
+    return good_messages, lines
+
+
+
+# Function to write the queued messages to the log file in batches
+def log_writer():
+    unflushed_size = 0
+    last_flush_time = time.perf_counter()
+    last_index_write_time = last_flush_time
+    stop = False
+
+    while not stop:
+        # Wait for the first message, then take everything that is waiting (up to the batch size)
+        batch = []
+        try:
+            batch.append(log_queue.get(timeout=log_flush_interval))
+            while len(batch) < log_batch_size:
+                batch.append(log_queue.get_nowait())
+        except queue.Empty:
+            pass
+
+        # None is put in the queue by stop_log_writer()
+        if None in batch:
+            stop = True
+            batch = [item for item in batch if item is not None]
+
+        if batch:
+            if Instrumentation.enabled:
+                start_time = time.perf_counter()
+
+            try:
+                batch, lines = format_batch(batch)
+                if log_index is not None:
+                    add_batch_to_index(batch, lines)
+                lines = ''.join(lines)
+                log_file.write(lines)
+                unflushed_size += len(lines)
+
+                with log_counters_lock:
+                    log_counters['written'] += len(batch)
+
+            # Error handling (e.g. disk full): the batch is lost, but the log writer keeps running
+            except Exception as e:
+                with log_counters_lock:
+                    log_counters['errors'] += len(batch)
+                print(f'Log writer: {len(batch)} messages not written: {e}')
+
+            # Time per message of this batch
+            if Instrumentation.enabled and batch:
+                Instrumentation.record('log write', (time.perf_counter() - start_time) / len(batch), len(batch))
+
+        # Flush on size or time
+        now = time.perf_counter()
+        if unflushed_size >= log_flush_size or now - last_flush_time >= log_flush_interval or stop:
+            try:
+                log_file.flush()
+
+                # Write the index after the flush, so all lines in it are on disk
+                if log_index is not None and (now - last_index_write_time >= index_write_interval or stop):
+                    ASC_index.write_index(log_index, log_file.name, log_offset)
+                    last_index_write_time = now
+
+            except Exception as e:
+                print(f'Log writer: {e}')
+
+            unflushed_size = 0
+            last_flush_time = now
+
+
+
+# Function to start the log writer thread
+def start_log_writer(file, start_time, index=True):
+    global log_file, start_time_logger, log_writer_thread, log_index, log_offset
+
+    log_file = file
+    start_time_logger = start_time
+
+    # The index starts after the header of the log file
+    if index:
+        log_file.flush()
+        log_index = ASC_index.new_index()
+        log_offset = log_file.tell()
+
+    log_writer_thread = Thread(target=log_writer)
+    log_writer_thread.daemon = True
+    log_writer_thread.start()
+
+    return log_writer_thread
+
+
+
+# Function to stop the log writer thread after all queued messages are written
+def stop_log_writer():
+    if log_writer_thread is not None and log_writer_thread.is_alive():
+        log_queue.put(None)
+        log_writer_thread.join()
+
+
+
+# Function to make a report of the counters of the log writer
+def format_log_counters():
+    with log_counters_lock:
+        return f'log: {log_counters["queued"]} queued, {log_counters["written"]} written, {log_counters["dropped"]} dropped, {log_counters["errors"]} errors'
+
+
+
+# Microbenchmark of format_message_for_log_file() against the old formatter (per-byte f-strings, time at write)
+def benchmark_format_message_for_log_file(number=200000):
+    message = can.Message(timestamp=time.time(), arbitration_id=0x18FFB331, data=[0x81, 0x22, 0x22, 0x00, 0x1E, 0x00, 0x00, 0x00], channel=0)
+    start_time = time.time()
+    start_perf_counter = time.perf_counter()
+
+    def format_message_for_log_file_old():
+        timestamp = time.perf_counter() - start_perf_counter
+        hex_data = ' '.join([f"{byte:02X}" for byte in message.data])
+        message_channel = message.channel + 1
+        ID_for_log_file = f'{message.arbitration_id:08X}x'
+        return f"{timestamp:.6f} {message_channel}  {ID_for_log_file}       Rx   d {message.dlc} {hex_data}"
+
+    time_old = min(timeit.repeat(format_message_for_log_file_old, number=number, repeat=5)) / number
+    time_new = min(timeit.repeat(lambda: format_message_for_log_file(message, start_time), number=number, repeat=5)) / number
+
+    print(f'old formatter: {time_old * 1e6:.2f} us/message')
+    print(f'new formatter: {time_new * 1e6:.2f} us/message ({time_old / time_new:.1f}x faster)')
+
+
+
+if __name__ == "__main__":
+    benchmark_format_message_for_log_file()
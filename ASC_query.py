@@ -0,0 +1,256 @@
+"""
+Author: Jens Segaert
+Company: VDL Bus Roeselare
+
+Python version: 3.11.5
+
+Description: Query tool for (large) ASC log files. The log is memory-mapped and divided in line-aligned chunks that are scanned
+in parallel by worker processes. Frames can be filtered by arbitration ID (or ID/mask), channel, time window and data pattern.
+The matching frames are written in order of the log as ASC (can be replayed with Main.py --replay) or CSV.
+If the log has a sidecar index (see ASC_index), only the parts of the log with the time window and IDs are read.
+Exact IDs (without masks) are first searched as text (as the loggers write them: hex in upper case), which is much faster than
+matching every line.
+
+Examples:
+python ASC_query.py "Log files\\can_log_....asc" --id 18FEF100 --start 120 --end 180
+python ASC_query.py "Log files\\can_log_....asc" --mask 18FEF100/1FFFFF00 --channel 2 --data "81 22 ?? 00" --format csv --output frames.csv
+"""
+
+import argparse
+import mmap
+import multiprocessing
+import os
+import re
+import sys
+import time
+import ASC_index
+
+
+
+chunk_size = 16 * 1024 * 1024  # Bytes per chunk of the log that one worker scans
+csv_header = 'time,channel,id,extended,direction,dlc,data\n'
+
+
+
+# Function to make the regular expression of the frame lines that match the channel and data filters.
+# The regular expression finds the lines in C, so lines that do not match cost almost nothing.
+def build_line_pattern(channels, data_pattern):
+    channel_pattern = '[0-9]+'
+    if channels:
+        channel_pattern = '(?:' + '|'.join(str(channel) for channel in sorted(channels)) + ')'
+
+    # Data pattern: hex bytes and ?? for any byte, at any position in the data
+    data_regex = ''
+    if data_pattern:
+        data_bytes = ['[0-9A-Fa-f]{2}' if data_byte == '??' else re.escape(data_byte.upper()) for data_byte in data_pattern.split()]
+        data_regex = '(?:[0-9A-Fa-f]{2} )*?' + ' '.join(data_bytes)
+
+    return re.compile(
+        rf'^ *(?P<time>[0-9]+\.[0-9]+) (?P<channel>{channel_pattern}) +(?P<id>[0-9A-Fa-f]+)(?P<extended>x?) +(?P<direction>Rx|Tx) +d '
+        rf'(?P<dlc>[0-9A-Fa-f]+) (?P<data>{data_regex}[^\r\n]*?) *\r?$'.encode('ascii'), re.MULTILINE)
+
+
+
+# Function to check an ID against ID/mask filters
+def matches_id_masks(arbitration_id, id_masks):
+    return any((arbitration_id ^ can_id) & can_mask == 0 for can_id, can_mask in id_masks)
+
+
+
+# Function to find the lines of a chunk that have one of the IDs in their text. Returns the (start, end) of these lines.
+# The text can also be found in other places (e.g. in a timestamp), the line pattern checks every line afterwards.
+def find_id_lines(log_map, start_offset, end_offset, arbitration_ids):
+    line_starts = set()
+    for arbitration_id in arbitration_ids:
+        id_text = f'{arbitration_id:X}'.encode('ascii')
+        position = log_map.find(id_text, start_offset, end_offset)
+        while position >= 0:
+            line_starts.add(log_map.rfind(b'\n', start_offset, position) + 1 or start_offset)
+            position = log_map.find(id_text, position + 1, end_offset)
+
+    id_lines = []
+    for line_start in sorted(line_starts):
+        line_end = log_map.find(b'\n', line_start, end_offset)
+        id_lines.append((line_start, end_offset if line_end < 0 else line_end))
+
+    return id_lines
+
+
+
+# Function to scan one chunk of the log. Returns the matching frames as ASC lines or CSV lines (bytes).
+# A frame matches if its ID is one of the IDs or matches one of the ID/masks (if there are any), and all other filters match.
+def scan_chunk(log_path, start_offset, end_offset, query):
+    line_pattern = build_line_pattern(query['channels'], query['data'])
+    arbitration_ids = query['ids']
+    id_masks = query['masks']
+    start_time = query['start']
+    end_time = query['end']
+    output_format = query['format']
+
+    matches = []
+    with open(log_path, 'rb') as log_file, mmap.mmap(log_file.fileno(), 0, access=mmap.ACCESS_READ) as log_map:
+        if arbitration_ids and not id_masks:
+            line_matches = (line_pattern.match(log_map, line_start, line_end) for line_start, line_end in find_id_lines(log_map, start_offset, end_offset, arbitration_ids))
+        else:
+            line_matches = line_pattern.finditer(log_map, start_offset, end_offset)
+
+        for match in line_matches:
+            if match is None:
+                continue
+
+            if arbitration_ids or id_masks:
+                arbitration_id = int(match['id'], 16)
+                if arbitration_id not in arbitration_ids and not matches_id_masks(arbitration_id, id_masks):
+                    continue
+
+            if start_time is not None or end_time is not None:
+                timestamp = float(match['time'])
+                if (start_time is not None and timestamp < start_time) or (end_time is not None and timestamp > end_time):
+                    continue
+
+            if output_format == 'csv':
+                matches.append(b','.join((match['time'], match['channel'], match['id'].upper(), b'1' if match['extended'] else b'0',
+                                          match['direction'], match['dlc'], match['data'].strip())) + b'\n')
+            else:
+                matches.append(match.group(0).rstrip(b'\r') + b'\n')
+
+    return b''.join(matches)
+
+
+
+# Function to get the parts (start, end) of the log to scan. With an index, only the buckets of the time window and IDs are scanned,
+# plus the end of the log that is not in the index yet.
+def get_scan_ranges(log_path, log_length, query, use_index):
+    index = ASC_index.read_index(log_path) if use_index else None
+    if index is None or index['log_size'] > log_length:
+        return [(0, log_length)]
+
+    if query['ids'] or query['masks']:
+        # IDs in the index that match the exact IDs or an ID/mask
+        indexed_ids = [arbitration_id for arbitration_id in index['id_buckets']
+                       if arbitration_id in query['ids'] or matches_id_masks(arbitration_id, query['masks'])]
+        buckets = sorted(set(bucket for arbitration_id in indexed_ids for bucket in ASC_index.find_buckets(index, query['start'], query['end'], arbitration_id)))
+    else:
+        buckets = ASC_index.find_buckets(index, query['start'], query['end'])
+
+    scan_ranges = ASC_index.get_byte_ranges(index, buckets, index['log_size'])
+    if index['log_size'] < log_length:
+        scan_ranges.append((index['log_size'], log_length))
+
+    return scan_ranges
+
+
+
+# Function to divide the scan ranges in chunks of about chunk_size bytes. Every chunk starts at the start of a line.
+def split_in_chunks(log_map, scan_ranges):
+    chunks = []
+    for start_offset, end_offset in scan_ranges:
+        while start_offset < end_offset:
+            chunk_end = min(start_offset + chunk_size, end_offset)
+            if chunk_end < end_offset:
+                line_end = log_map.find(b'\n', chunk_end, end_offset)
+                chunk_end = end_offset if line_end < 0 else line_end + 1
+            chunks.append((start_offset, chunk_end))
+            start_offset = chunk_end
+
+    return chunks
+
+
+
+# Function to get the header of the log (up to and with 'Start of measurement'), so the ASC output is a valid log file
+def get_log_header(log_map):
+    header_end = log_map.find(b'Start of measurement', 0, 64 * 1024)
+    if header_end < 0:
+        return b''
+    return log_map[:log_map.find(b'\n', header_end) + 1].replace(b'\r\n', b'\n')
+
+
+
+# Function to run a query on a log file and write the matches to output_file (binary). Returns (matching bytes, scanned bytes).
+def run_query(log_path, query, output_file, jobs, use_index=True):
+    with open(log_path, 'rb') as log_file, mmap.mmap(log_file.fileno(), 0, access=mmap.ACCESS_READ) as log_map:
+        scan_ranges = get_scan_ranges(log_path, len(log_map), query, use_index)
+        chunks = split_in_chunks(log_map, scan_ranges)
+        log_header = get_log_header(log_map)
+
+    if query['format'] == 'csv':
+        output_file.write(csv_header.encode('ascii'))
+    else:
+        output_file.write(log_header)
+
+    output_size = 0
+    chunk_arguments = [(log_path, start_offset, end_offset, query) for start_offset, end_offset in chunks]
+
+    # The chunks are scanned in parallel, the results are written in order of the log as soon as they are ready
+    if jobs > 1 and len(chunks) > 1:
+        with multiprocessing.get_context('spawn').Pool(min(jobs, len(chunks))) as pool:
+            for matches in pool.imap(scan_chunk_arguments, chunk_arguments):
+                output_file.write(matches)
+                output_size += len(matches)
+    else:
+        for arguments in chunk_arguments:
+            matches = scan_chunk_arguments(arguments)
+            output_file.write(matches)
+            output_size += len(matches)
+
+    if query['format'] != 'csv':
+        output_file.write(b'End TriggerBlock\n')
+
+    return output_size, sum(end_offset - start_offset for start_offset, end_offset in chunks)
+
+
+
+# Function to call scan_chunk() with one tuple of arguments (for Pool.imap)
+def scan_chunk_arguments(arguments):
+    return scan_chunk(*arguments)
+
+
+
+# Function to read an ID/mask argument, e.g. '18FEF100/1FFFFF00'
+def parse_id_mask(text):
+    can_id, can_mask = text.split('/')
+    return int(can_id, 16), int(can_mask, 16)
+
+
+
+# Main function
+def main():
+    parser = argparse.ArgumentParser(description="Get the frames of an ASC log file that match the filters, as ASC or CSV.")
+    parser.add_argument("log_file", help="ASC log file")
+    parser.add_argument("--id", nargs="+", default=[], type=lambda text: int(text, 16), help="arbitration IDs (hex)")
+    parser.add_argument("--mask", nargs="+", default=[], type=parse_id_mask, help="ID/mask (hex), e.g. 18FEF100/1FFFFF00 for every source address")
+    parser.add_argument("--channel", nargs="+", default=[], type=int, help="channels (as in the log, starting at 1)")
+    parser.add_argument("--start", type=float, help="start of the time window in seconds")
+    parser.add_argument("--end", type=float, help="end of the time window in seconds")
+    parser.add_argument("--data", help="data pattern: hex bytes, ?? for any byte, e.g. \"81 22 ?? 00\"")
+    parser.add_argument("--format", choices=["asc", "csv"], default="asc", help="output format (default: asc)")
+    parser.add_argument("--output", help="output file (default: stdout)")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count() or 1, help="number of worker processes (default: number of cores)")
+    parser.add_argument("--no-index", action="store_true", help="scan the whole log, also if it has an index")
+    arguments = parser.parse_args()
+
+    query = {
+        'ids': set(arguments.id),
+        'masks': arguments.mask,
+        'channels': set(arguments.channel),
+        'start': arguments.start,
+        'end': arguments.end,
+        'data': arguments.data,
+        'format': arguments.format
+    }
+
+    start_time = time.perf_counter()
+    if arguments.output:
+        with open(arguments.output, 'wb') as output_file:
+            output_size, scanned_size = run_query(arguments.log_file, query, output_file, arguments.jobs, not arguments.no_index)
+    else:
+        output_size, scanned_size = run_query(arguments.log_file, query, sys.stdout.buffer, arguments.jobs, not arguments.no_index)
+    elapsed_time = time.perf_counter() - start_time
+
+    print(f'{scanned_size / 1e6:.1f} MB scanned in {elapsed_time:.2f} s ({scanned_size / 1e6 / max(elapsed_time, 1e-9):.0f} MB/s), '
+          f'{output_size} bytes of matches', file=sys.stderr)
+
+
+
+if __name__ == "__main__":
+    main()
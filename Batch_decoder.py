@@ -0,0 +1,276 @@
+"""
+Author: Jens Segaert
+Company: VDL Bus Roeselare
+
+Python version: 3.11.5
+
+Description: Vectorized decoding of many frames of one message at once (offline analysis of large log files).
+The payloads of one message are given as a 2-D NumPy byte array (one row per frame). Every signal is cut out of all rows
+together with shifts and masks, made signed, scaled and offset, so one array per signal is returned.
+Intel (little endian) and Motorola (big endian) signals, floats, choices and (nested) multiplexers are decoded like
+cantools Message.decode(); a row that cantools can not decode (unknown multiplexer value) is marked invalid.
+Choice values are given as their number (NamedSignalValue.value), names can be found with signal.choices.
+Signals that need more than 64 bits of payload, or longer than 53 bits (larger than a float can hold exactly), are
+calculated with Python integers, so they are exact too.
+
+Check against cantools with random payloads: python Batch_decoder.py "Databases CAN\*.dbc" --frames 1000
+"""
+
+import argparse
+import glob
+import sys
+
+import numpy
+import cantools
+from cantools.database.conversion import BaseConversion, IdentityConversion
+from cantools.database.errors import DecodeError
+from cantools.database.namedsignalvalue import NamedSignalValue
+
+
+
+max_vectorized_length = 53  # Longer signals are calculated with Python integers
+
+
+
+# Function to get the bytes of the payload that hold a signal: (first byte, number of bytes, shift to the lowest bit).
+# The bytes are read as one integer: little endian for Intel signals, big endian for Motorola signals.
+def get_signal_layout(signal):
+    if signal.byte_order == 'little_endian':
+        first_bit = signal.start
+        first_byte = first_bit // 8
+        last_byte = (first_bit + signal.length - 1) // 8
+        shift = first_bit % 8
+    else:
+        # Motorola start bit is the most significant bit in sawtooth numbering, first_bit is it in network numbering
+        first_bit = 8 * (signal.start // 8) + (7 - signal.start % 8)
+        first_byte = first_bit // 8
+        last_byte = (first_bit + signal.length - 1) // 8
+        shift = 8 * (last_byte + 1) - (first_bit + signal.length)
+
+    return first_byte, last_byte - first_byte + 1, shift
+
+
+
+# Function to get the raw (unscaled) values of a signal from all payloads
+def extract_raw_values(signal, payloads):
+    first_byte, number_of_bytes, shift = get_signal_layout(signal)
+    mask = (1 << signal.length) - 1
+    byte_order = 'little' if signal.byte_order == 'little_endian' else 'big'
+
+    # Exact path with Python integers
+    if number_of_bytes > 8 or (signal.length > max_vectorized_length and not signal.is_float):
+        raw_values = numpy.empty(len(payloads), dtype=object)
+        for row, payload in enumerate(payloads[:, first_byte:first_byte + number_of_bytes]):
+            raw_value = (int.from_bytes(payload.tobytes(), byte_order) >> shift) & mask
+            if signal.is_signed and raw_value >> (signal.length - 1):
+                raw_value -= 1 << signal.length
+            raw_values[row] = raw_value
+        if signal.is_float:
+            raw_values = convert_to_float(raw_values.astype(numpy.uint64), signal.length)
+        return raw_values
+
+    # The bytes of the signal as one unsigned 64-bit integer per row
+    window = numpy.zeros(len(payloads), dtype=numpy.uint64)
+    for position in range(number_of_bytes):
+        byte_shift = 8 * position if byte_order == 'little' else 8 * (number_of_bytes - 1 - position)
+        window |= payloads[:, first_byte + position].astype(numpy.uint64) << numpy.uint64(byte_shift)
+    raw_values = (window >> numpy.uint64(shift)) & numpy.uint64(mask)
+
+    if signal.is_float:
+        return convert_to_float(raw_values, signal.length)
+
+    raw_values = raw_values.astype(numpy.int64)
+    if signal.is_signed:
+        raw_values = numpy.where(raw_values >> (signal.length - 1) != 0, raw_values - (1 << signal.length), raw_values)
+
+    return raw_values
+
+
+
+# Function to read the bits of float signals (16, 32 or 64 bits) as IEEE floats
+def convert_to_float(raw_values, length):
+    float_types = {16: (numpy.uint16, numpy.float16), 32: (numpy.uint32, numpy.float32), 64: (numpy.uint64, numpy.float64)}
+    integer_type, float_type = float_types[length]
+    return raw_values.astype(integer_type).view(float_type).astype(numpy.float64)
+
+
+
+# Function to scale raw values like cantools: the same conversion (identity, integer or float) and the same Python number types.
+# Integer arrays times an int stay integers, times a float become floats, just like raw_value * scale + offset in cantools.
+def scale_raw_values(signal, raw_values):
+    conversion = BaseConversion.factory(scale=signal.scale, offset=signal.offset, choices=None, is_float=signal.is_float)
+    if isinstance(conversion, IdentityConversion):
+        return raw_values
+
+    return raw_values * conversion.scale + conversion.offset
+
+
+
+# Function to get the choice numbers (the raw values that have a choice) of a signal as a boolean array per row
+def find_choice_rows(signal, raw_values):
+    choice_numbers = numpy.array(list(signal.choices.keys()), dtype=numpy.int64)
+    if signal.is_float:
+        raw_values = numpy.trunc(numpy.where(numpy.isfinite(raw_values), raw_values, 0.5))
+
+    return numpy.isin(raw_values, choice_numbers)
+
+
+
+# Function to decode all payloads of one message (2-D uint8 array, one row per frame, at least message.length bytes per row).
+# Returns (valid, signal_values): valid is True for the rows that cantools can decode, signal_values has per signal
+# (values, present) where present is True for the rows that have the signal (multiplexed signals are only in some rows).
+def decode_batch(message, payloads, decode_choices=True):
+    payloads = numpy.asarray(payloads, dtype=numpy.uint8).reshape(len(payloads), -1)
+    if payloads.shape[1] < message.length:
+        raise DecodeError(f'Wrong data size: {payloads.shape[1]} instead of {message.length} bytes')
+    payloads = numpy.ascontiguousarray(payloads[:, :message.length])
+
+    number_of_rows = len(payloads)
+    valid = numpy.ones(number_of_rows, dtype=bool)
+    signal_values = {}
+    multiplexer_numbers = {}
+
+    # Signals are decoded after their multiplexer signal, so it is known which rows have them
+    multiplexer_names = {signal.name for signal in message.signals if signal.is_multiplexer}
+    remaining_signals = list(message.signals)
+    while remaining_signals:
+        signals = remaining_signals
+        remaining_signals = []
+
+        for signal in signals:
+            if signal.multiplexer_signal is None:
+                present = numpy.ones(number_of_rows, dtype=bool)
+            elif signal.multiplexer_signal in multiplexer_numbers:
+                multiplexer_values, multiplexer_present = multiplexer_numbers[signal.multiplexer_signal]
+                present = multiplexer_present & numpy.isin(multiplexer_values, list(signal.multiplexer_ids or []))
+            elif signal.multiplexer_signal in multiplexer_names:
+                remaining_signals.append(signal)
+                continue
+            else:
+                present = numpy.zeros(number_of_rows, dtype=bool)
+
+            raw_values = extract_raw_values(signal, payloads)
+            values = scale_raw_values(signal, raw_values)
+
+            # Float raw values that are not finite can not be looked up in the choices (cantools raises an error)
+            if signal.is_float and signal.choices and decode_choices:
+                valid &= ~present | numpy.isfinite(raw_values)
+
+            choice_rows = None
+            if decode_choices and signal.choices:
+                choice_rows = find_choice_rows(signal, raw_values)
+                choice_numbers = numpy.trunc(raw_values) if signal.is_float else raw_values
+                values = numpy.where(choice_rows, choice_numbers, values)
+
+            signal_values[signal.name] = (values, present)
+
+            if signal.is_multiplexer:
+                multiplexer_numbers[signal.name] = (get_multiplexer_numbers(signal, values, raw_values, choice_rows), present)
+
+                # A multiplexer value without signals (or choice) can not be decoded by cantools
+                multiplexer_ids = {multiplexer_id for child_signal in message.signals if child_signal.multiplexer_signal == signal.name
+                                   for multiplexer_id in (child_signal.multiplexer_ids or [])}
+                multiplexer_ids.update((signal.choices or {}).keys())
+                valid &= ~present | numpy.isin(multiplexer_numbers[signal.name][0], list(multiplexer_ids))
+
+    for name, (values, present) in signal_values.items():
+        signal_values[name] = (values, present & valid)
+
+    return valid, signal_values
+
+
+
+# Function to get the multiplexer number per row, like cantools: the number of the choice (looked up by its name), else int(value)
+def get_multiplexer_numbers(signal, values, raw_values, choice_rows):
+    multiplexer_numbers = numpy.trunc(values).astype(numpy.int64) if values.dtype.kind == 'f' else values.astype(numpy.int64)
+    if choice_rows is not None:
+        for choice_number, choice in signal.choices.items():
+            number = signal.conversion.choice_to_number(str(choice))
+            multiplexer_numbers = numpy.where(choice_rows & (raw_values == choice_number), number, multiplexer_numbers)
+
+    return multiplexer_numbers
+
+
+
+# Function to compare a decoded value with the value of cantools: the same number and the same kind (integer or float).
+# A choice (NamedSignalValue) only has to have the same number.
+def is_same_value(value, expected_value):
+    if isinstance(expected_value, NamedSignalValue):
+        return value == expected_value.value
+    if isinstance(expected_value, int):
+        return isinstance(value, (int, numpy.integer)) and value == expected_value
+    return isinstance(value, (float, numpy.floating)) and (value == expected_value or (numpy.isnan(value) and numpy.isnan(expected_value)))
+
+
+
+# Function to compare decode_batch() with cantools for random payloads of all messages of a database.
+# Returns the number of compared frames and a list of differences.
+def check_database(db, number_of_frames, seed=1):
+    random_generator = numpy.random.default_rng(seed)
+    number_of_compared_frames = 0
+    differences = []
+
+    for message in db.messages:
+        payloads = random_generator.integers(0, 256, size=(number_of_frames, message.length), dtype=numpy.uint8)
+
+        # Half of the rows get a valid multiplexer value (random values are mostly unknown multiplexer values)
+        for row in range(0, number_of_frames, 2):
+            multiplexed_signals = [signal for signal in message.signals if signal.multiplexer_ids]
+            if multiplexed_signals:
+                signal = multiplexed_signals[random_generator.integers(len(multiplexed_signals))]
+                try:
+                    encoded = message.encode({**{s.name: 0 for s in message.signals}, signal.multiplexer_signal: signal.multiplexer_ids[0]}, strict=False)
+                    payloads[row] = numpy.frombuffer(encoded, dtype=numpy.uint8)
+                except Exception:
+                    pass
+
+        valid, signal_values = decode_batch(message, payloads)
+
+        for row, payload in enumerate(payloads):
+            number_of_compared_frames += 1
+            try:
+                expected = message.decode(payload.tobytes())
+            except Exception:
+                expected = None
+
+            if expected is None or not valid[row]:
+                if (expected is None) != (not valid[row]):
+                    differences.append(f'{message.name} {payload.tobytes().hex()}: valid {bool(valid[row])}, cantools {expected is not None}')
+                continue
+
+            decoded = {name: values[row] for name, (values, present) in signal_values.items() if present[row]}
+            if decoded.keys() != expected.keys():
+                differences.append(f'{message.name} {payload.tobytes().hex()}: signals {sorted(decoded)} instead of {sorted(expected)}')
+                continue
+
+            for name, expected_value in expected.items():
+                if not is_same_value(decoded[name], expected_value):
+                    differences.append(f'{message.name}.{name} {payload.tobytes().hex()}: {decoded[name]!r} instead of {expected_value!r}')
+
+    return number_of_compared_frames, differences
+
+
+
+# Main function: check the batch decoder against cantools
+def main():
+    parser = argparse.ArgumentParser(description="Compare the vectorized batch decoder with cantools for random payloads.")
+    parser.add_argument("dbc_files", nargs="+", help="DBC files (wildcards allowed)")
+    parser.add_argument("--frames", type=int, default=1000, help="random frames per message (default: 1000)")
+    arguments = parser.parse_args()
+
+    number_of_differences = 0
+    for dbc_pattern in arguments.dbc_files:
+        for dbc_filename in glob.glob(dbc_pattern) or [dbc_pattern]:
+            db = cantools.database.load_file(dbc_filename, strict=False)
+            number_of_compared_frames, differences = check_database(db, arguments.frames)
+            number_of_differences += len(differences)
+            for difference in differences[:20]:
+                print(difference)
+            print(f'{dbc_filename}: {len(db.messages)} messages, {number_of_compared_frames} frames, {len(differences)} differences')
+
+    sys.exit(1 if number_of_differences else 0)
+
+
+
+if __name__ == "__main__":
+    main()
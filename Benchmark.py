@@ -0,0 +1,384 @@
+"""
+Author: Jens Segaert
+Company: VDL Bus Roeselare
+
+Python version: 3.11.5
+
+Description: Benchmark of the receive/decode/log pipeline of Main (or CAN-viewer) without CAN-interface and without GUI.
+Synthetic J1939 and VFC_EPIC traffic is made from the DBC files and sent on the python-can virtual interface at a fixed rate.
+The sustained throughput, end-to-end latency percentiles (send until the message is processed; with decode workers, until it is
+handed to its worker), drop counts
+and CPU time are written as JSON, so results of different versions can be compared.
+
+Example: python Benchmark.py --rate 1000 5000 10000 --ids 200 --duration 10 --output benchmark.json
+"""
+
+import argparse
+import importlib.util
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from array import array
+from threading import Thread
+
+import can
+import cantools
+import ASC_logger
+import Instrumentation
+import Main
+
+
+
+script_directory = os.path.dirname(os.path.abspath(__file__))
+default_config_file_path = os.path.join(script_directory, "Configuration files", "vector__2channels", "test_ICAN-en-FMS__vector__2channels.json")
+default_dbc_filenames = [os.path.join(script_directory, "Databases CAN", "j1939-kopie.dbc"), os.path.join(script_directory, "Databases CAN", "VFC_EPIC.dbc")]
+
+drain_timeout = 5.0  # Seconds to wait for the pipeline to process the messages that are still queued after sending
+payloads_per_id = 8  # Different payloads per ID, sent in turn
+max_payload_attempts = 1000  # Random payloads tried per payload of a multiplexed message
+
+# Latency (in seconds) of every processed message, appended by the receive threads
+latencies = array('d')
+
+
+
+# Function to make a random payload of a message. Multiplexed messages need a multiplexer value that is in the database,
+# so random payloads are tried until one decodes (None if none is found).
+def make_payload(message, rng):
+    for attempt in range(max_payload_attempts):
+        payload = bytes(rng.randrange(256) for _ in range(message.length))
+        if not message.is_multiplexed():
+            return payload
+
+        try:
+            message.decode(payload)
+            return payload
+        except Exception:
+            continue
+
+    return None
+
+
+
+# Function to make the synthetic traffic: ids_count (ID, extended, payloads) from the messages in the DBC files.
+# J1939 messages with source address 0xFE in the database get a source address below 50, like the ECUs Main decodes.
+# With can_filters, only IDs that pass the acceptance filters are used (so every message is decoded).
+def make_traffic(dbc_filenames, ids_count, seed, can_filters=None):
+    rng = random.Random(seed)
+    messages = [message for dbc_filename in dbc_filenames for message in cantools.database.load_file(dbc_filename, strict=False).messages]
+
+    traffic = []
+    used_ids = set()
+    for attempt in range(100 * ids_count):
+        if len(traffic) == ids_count:
+            break
+
+        message = rng.choice(messages)
+        arbitration_id = message.frame_id
+        if message.is_extended_frame and arbitration_id & 0xff == 0xfe:
+            arbitration_id = (arbitration_id & 0x1fffff00) | rng.randrange(50)
+
+        if arbitration_id in used_ids or not Main.matches_can_filters(arbitration_id, message.is_extended_frame, can_filters):
+            continue
+        used_ids.add(arbitration_id)
+
+        payloads = [make_payload(message, rng) for _ in range(payloads_per_id)]
+        if None in payloads:
+            continue
+
+        traffic.append((arbitration_id, message.is_extended_frame, payloads))
+
+    return traffic
+
+
+
+# Function to make the JSON configuration of Main: Field_parameters of the base configuration, virtual interfaces and the given DBC files
+def make_config_file(base_config_file_path, dbc_filenames, channels_count):
+    with open(base_config_file_path, 'r') as json_file:
+        config_data = json.load(json_file)
+
+    for i in range(1, 11):
+        config_data[f"Locatie Database CAN{i}"] = dbc_filenames[i - 1] if i <= len(dbc_filenames) else ""
+    for i in range(1, 7):
+        config_data[f"Interface{i}"] = "virtual" if i <= channels_count else ""
+        config_data[f"Channel{i}"] = i if i <= channels_count else ""
+        config_data[f"Bitrate{i}"] = 250000 if i <= channels_count else ""
+
+    config_file = tempfile.NamedTemporaryFile('w', suffix='.json', delete=False)
+    json.dump(config_data, config_file, indent=1)
+    config_file.close()
+
+    return config_file.name
+
+
+
+# Function to wrap the last step of a pipeline, so every processed message records its latency
+def record_latency(process_function):
+    def process_function_with_latency(message):
+        process_function(message)
+        latencies.append(time.time() - message.timestamp)
+
+    return process_function_with_latency
+
+
+
+# Function to start the pipeline of Main on virtual channels 1 - channels_count. The log file of Main is made in a temporary folder,
+# so a benchmark never leaves log files between the real logs in 'Log files'.
+# Returns the acceptance filters, a stop function and a function that gives the counters of the pipeline.
+def start_main_pipeline(config_file_path, ingest_policy, ingest_buffer_size, decode_workers, decode_cache_size):
+    log_directory = tempfile.mkdtemp(prefix='benchmark_log_')
+    Main.create_log_file_path = lambda: os.path.join(log_directory, 'can_log_benchmark.asc')
+
+    Main.ingest_policy = ingest_policy
+    Main.ingest_buffer_size = ingest_buffer_size
+    Main.decode_cache_size = decode_cache_size
+    Main.process_can_message = record_latency(Main.process_can_message)
+    Main.init(config_file_path=config_file_path, headless=True)
+    if decode_workers > 0:
+        Main.start_decode_workers(decode_workers)
+    Main.start_receive_threads()
+
+    def stop_main_pipeline():
+        Main.wait_for_decode_workers(drain_timeout)
+        Main.exit_handler()
+        # The log file and its index are only made for the benchmark
+        shutil.rmtree(log_directory, ignore_errors=True)
+
+    def get_main_counters():
+        return {
+            'driver_overflows': sum(statistics['overflows'] for statistics in Main.channel_statistics.values()),
+            'ingest': {'policy': Main.ingest_policy, 'size': Main.ingest_buffer_size, **Main.ingest_statistics},
+            'decode_workers': {'workers': decode_workers, **Main.decode_worker_counters},
+            'decode_memo': {'cache_size': Main.decode_cache_size, **Main.decode_memo_statistics}
+        }
+
+    return Main.build_can_filters(Main.subscribed_messages) or None, stop_main_pipeline, get_main_counters
+
+
+
+# Function to start the pipeline of CAN-viewer on virtual channels 1 - channels_count.
+# Returns the acceptance filters (none), a stop function and a function that gives the counters of the pipeline.
+def start_viewer_pipeline(channels_count):
+    # Putting the message in the queue of the log writer is the last step of CAN-viewer
+    ASC_logger.write_message_to_log_file = record_latency(ASC_logger.write_message_to_log_file)
+
+    spec = importlib.util.spec_from_file_location("CAN_viewer", os.path.join(script_directory, "CAN-viewer.py"))
+    viewer = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(viewer)
+
+    log_file = tempfile.NamedTemporaryFile('w', suffix='.asc', delete=False)
+    viewer.log_file = log_file
+    ASC_logger.start_log_writer(log_file, time.time(), index=False)
+
+    for channel_index in range(channels_count):
+        viewer.can_configurations.append(("virtual", channel_index + 1, 250000))
+        viewer.channel_bits.append(0)
+        bus = can.interface.Bus(interface="virtual", channel=channel_index + 1)
+
+        receive_thread = Thread(target=viewer.receive_can_messages, args=(bus, channel_index))
+        receive_thread.daemon = True
+        receive_thread.start()
+
+    def stop_viewer_pipeline():
+        viewer.exit_handler()
+        os.remove(log_file.name)
+
+    return None, stop_viewer_pipeline, lambda: {}
+
+
+
+# Function to send the traffic at rate messages per second for duration seconds, the IDs in turn over the channels.
+# Returns the number of sent messages and the number of messages that pass the acceptance filters.
+def send_traffic(traffic, rate, duration, channels_count, can_filters):
+    buses = [can.interface.Bus(interface="virtual", channel=channel_index + 1) for channel_index in range(channels_count)]
+    messages = [can.Message(arbitration_id=arbitration_id, is_extended_id=is_extended_id, data=payloads[payload_index])
+                for payload_index in range(payloads_per_id) for arbitration_id, is_extended_id, payloads in traffic]
+    accepted = [Main.matches_can_filters(message.arbitration_id, message.is_extended_id, can_filters) for message in messages]
+
+    sent_count = 0
+    accepted_count = 0
+    start_time = time.perf_counter()
+    end_time = start_time + duration
+
+    while True:
+        now = time.perf_counter()
+        if now >= end_time:
+            break
+
+        # Send all messages that are due, then wait a millisecond
+        due_count = int((now - start_time) * rate)
+        while sent_count < due_count:
+            message_index = sent_count % len(messages)
+            buses[sent_count % channels_count].send(messages[message_index])
+            accepted_count += accepted[message_index]
+            sent_count += 1
+
+        time.sleep(0.001)
+
+    for bus in buses:
+        bus.shutdown()
+
+    return sent_count, accepted_count, time.perf_counter() - start_time
+
+
+
+# Function to get the latency percentiles in microseconds
+def get_latency_percentiles(latency_values):
+    if len(latency_values) < 2:
+        return {}
+
+    sorted_latencies = sorted(latency_values)
+    quantiles = statistics.quantiles(sorted_latencies, n=1000, method='inclusive')
+
+    return {
+        'mean': statistics.fmean(sorted_latencies) * 1e6,
+        'p50': quantiles[499] * 1e6,
+        'p90': quantiles[899] * 1e6,
+        'p99': quantiles[989] * 1e6,
+        'p99.9': quantiles[998] * 1e6,
+        'max': sorted_latencies[-1] * 1e6
+    }
+
+
+
+# Function to run one benchmark at one rate and return the results
+def run_benchmark(target, rate, ids_count, duration, channels_count, config_file_path, dbc_filenames, seed, instrument, decoded_only, ingest_policy, ingest_buffer_size, decode_workers, decode_cache_size):
+    if instrument:
+        Instrumentation.enable()
+
+    if target == 'main':
+        main_config_file_path = make_config_file(config_file_path, dbc_filenames, channels_count)
+        can_filters, stop_pipeline, get_pipeline_counters = start_main_pipeline(main_config_file_path, ingest_policy, ingest_buffer_size, decode_workers, decode_cache_size)
+        os.remove(main_config_file_path)
+    else:
+        can_filters, stop_pipeline, get_pipeline_counters = start_viewer_pipeline(channels_count)
+
+    # The pipeline is always stopped (and its log removed), also if the run fails or is interrupted
+    try:
+        traffic = make_traffic(dbc_filenames, ids_count, seed, can_filters if decoded_only else None)
+
+        cpu_start_time = time.process_time()
+        sent_count, accepted_count, send_time = send_traffic(traffic, rate, duration, channels_count, can_filters)
+
+        # Wait until all accepted messages are processed (or nothing changes any more)
+        drain_start_time = time.perf_counter()
+        while len(latencies) < accepted_count and time.perf_counter() - drain_start_time < drain_timeout:
+            time.sleep(0.01)
+        processing_time = send_time + time.perf_counter() - drain_start_time
+        cpu_time = time.process_time() - cpu_start_time
+
+    finally:
+        stop_pipeline()
+
+    processed_count = len(latencies)
+
+    results = {
+        'target': target,
+        'rate': rate,
+        'ids': len(traffic),
+        'decoded_only': decoded_only,
+        'channels': channels_count,
+        'duration_s': duration,
+        'sent': sent_count,
+        'send_rate': sent_count / send_time,
+        'accepted': accepted_count,
+        'processed': processed_count,
+        'dropped': accepted_count - processed_count,
+        **get_pipeline_counters(),
+        'log': dict(ASC_logger.log_counters),
+        'throughput_fps': processed_count / processing_time,
+        'latency_us': get_latency_percentiles(latencies),
+        'cpu_s': cpu_time,
+        'cpu_percent': cpu_time / processing_time * 100,
+        'python': platform.python_version(),
+        'python_can': can.__version__,
+        'cantools': cantools.__version__,
+        'time': time.strftime('%Y-%m-%d %H:%M:%S')
+    }
+    if instrument:
+        results['stages'] = Instrumentation.get_report()
+
+    return results
+
+
+
+# Function to run every rate in its own process (the pipeline keeps its state in module globals) and collect the results
+def run_benchmarks_in_processes(arguments):
+    all_results = []
+    for rate in arguments.rate:
+        with tempfile.TemporaryDirectory() as temporary_directory:
+            output_file_path = os.path.join(temporary_directory, 'results.json')
+            command = [sys.executable, os.path.abspath(__file__), '--target', arguments.target, '--rate', str(rate), '--ids', str(arguments.ids),
+                       '--duration', str(arguments.duration), '--channels', str(arguments.channels), '--config', arguments.config,
+                       '--seed', str(arguments.seed), '--ingest-policy', arguments.ingest_policy, '--ingest-size', str(arguments.ingest_size),
+                       '--decode-workers', str(arguments.decode_workers), '--decode-cache-size', str(arguments.decode_cache_size),
+                       '--output', output_file_path, '--dbc', *arguments.dbc]
+            if arguments.instrument:
+                command.append('--instrument')
+            if arguments.all_ids:
+                command.append('--all-ids')
+
+            subprocess.run(command, check=True, stdout=subprocess.DEVNULL)
+            with open(output_file_path, 'r') as results_file:
+                all_results.extend(json.load(results_file))
+
+    return all_results
+
+
+
+# Function to print a short summary line of one result
+def format_results(results):
+    latency = results['latency_us']
+    return (f"{results['target']} {results['rate']:>8.0f} msg/s: {results['throughput_fps']:.0f} msg/s processed, {results['dropped']} dropped, "
+            f"latency p50 {latency.get('p50', 0):.0f} us p99 {latency.get('p99', 0):.0f} us max {latency.get('max', 0):.0f} us, cpu {results['cpu_percent']:.0f} %")
+
+
+
+# Main function
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the receive/decode/log pipeline on the python-can virtual interface.")
+    parser.add_argument("--target", choices=["main", "viewer"], default="main", help="pipeline of Main.py or CAN-viewer.py (default: main)")
+    parser.add_argument("--rate", type=float, nargs="+", default=[2000.0], help="messages per second, several rates run one after the other (default: 2000)")
+    parser.add_argument("--ids", type=int, default=100, help="number of different IDs (default: 100)")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds of traffic per rate (default: 10)")
+    parser.add_argument("--channels", type=int, default=1, choices=range(1, 7), help="number of virtual channels (default: 1)")
+    parser.add_argument("--config", default=default_config_file_path, help="JSON configuration with the Field_parameters of Main")
+    parser.add_argument("--dbc", nargs="+", default=default_dbc_filenames, help="DBC files for the traffic and the decoding (default: J1939 and VFC_EPIC)")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the random IDs and payloads (default: 0)")
+    parser.add_argument("--instrument", action="store_true", help="add the latency histograms of the stages (see Instrumentation.py)")
+    parser.add_argument("--all-ids", action="store_true", help="send all IDs of the DBC files, also the ones the acceptance filters of Main reject "
+                                                               "(default: only IDs that Main decodes)")
+    parser.add_argument("--ingest-policy", choices=["block", "drop-oldest", "keep-latest"], default="block", help="policy of the ingest buffer of Main (default: block)")
+    parser.add_argument("--ingest-size", type=int, default=10000, help="size of the ingest buffer of Main (default: 10000)")
+    parser.add_argument("--decode-workers", type=int, default=0, help="number of decode worker processes of Main (default: 0)")
+    parser.add_argument("--decode-cache-size", type=int, default=0, help="size of the LRU cache of decoded payloads of Main (default: 0, off)")
+    parser.add_argument("--output", metavar="JSON_FILE", help="write the results to this file")
+    arguments = parser.parse_args()
+
+    if len(arguments.rate) > 1:
+        all_results = run_benchmarks_in_processes(arguments)
+    else:
+        all_results = [run_benchmark(arguments.target, arguments.rate[0], arguments.ids, arguments.duration, arguments.channels,
+                                     arguments.config, arguments.dbc, arguments.seed, arguments.instrument, not arguments.all_ids,
+                                     arguments.ingest_policy, arguments.ingest_size, arguments.decode_workers, arguments.decode_cache_size)]
+
+    for results in all_results:
+        print(format_results(results))
+
+    if arguments.output:
+        with open(arguments.output, 'w') as results_file:
+            json.dump(all_results, results_file, indent=2)
+    else:
+        print(json.dumps(all_results, indent=2))
+
+
+
+if __name__ == "__main__":
+    main()
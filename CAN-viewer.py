@@ -5,7 +5,9 @@ Company: VDL Bus Roeselare
 Python version: 3.11.5
 
 Description: This script let's you see all incoming CAN-messages through interface.
-The hexadecimal ID, length, data, cycle time and counter is shown for each message.
+The channel, hexadecimal ID, length, data, cycle time (last, min, max, mean and jitter) and counter is shown for each message.
+The same ID on two channels has its own row.
+The bus load of each channel is estimated from the DLC of the messages and the bitrate.
 Also, a log file is made from all the CAN-messages in the folder "Log files".
 """
 
@@ -19,16 +21,39 @@ from tkinter import filedialog
 import os
 import datetime
 import atexit
-
-
-# Dictionary to hold message info
-message_data = {}
-
-# Een lock voor synchronisatie van toegang tot message_data
+import math
+from array import array
+import ASC_logger
+
+
+# Message info and running statistics of the cycle time (in ms) per (channel, ID). Every (channel, ID) has a slot in compact arrays,
+# so memory only grows with the number of IDs and stays flat during long sessions.
+message_slots = {}
+message_counts = array('Q')
+message_lengths = array('B')
+message_payloads = []
+last_times = array('d')
+cycle_times = array('d')
+cycle_minimums = array('d')
+cycle_maximums = array('d')
+cycle_means = array('d')
+cycle_m2s = array('d')  # Sum of squared differences from the mean (Welford), for the jitter
+
+# Een lock voor synchronisatie van toegang tot de message info
 message_data_lock = threading.Lock()
 
+# Bits on the bus per channel (for the bus load) and the bus load of the last GUI refresh
+channel_bits = []
+bus_load_state = {'time': None, 'bits': []}
+
 can_configurations = []
 
+# (channel, ID) that received a message since the last GUI refresh, Treeview item per (channel, ID) and the values shown in each row
+dirty_message_keys = set()
+treeview_items = {}
+rendered_rows = {}
+gui_refresh_interval = 200  # GUI refresh in milliseconds
+
 
 
 def load_json():
@@ -84,18 +109,27 @@ def setup_can_buses():
 
 # Function to create the GUI
 def create_gui():
-    global root, treeview
+    global root, treeview, bus_load_label
     # Make tkinter window
     root = tk.Tk()
     root.title("CAN Message Viewer")
     root.state('zoomed')
     root.geometry("800x600")  # Change geometry
 
-    treeview = ttk.Treeview(root, columns=("ID", "Length", "Data", "Cycle Time", "Count"), show="headings")
+    bus_load_label = tk.Label(root, text="Bus load: -")
+    bus_load_label.pack()
+
+    treeview = ttk.Treeview(root, columns=("Ch", "ID", "Length", "Data", "Cycle Time", "Min", "Max", "Mean", "Jitter", "Count"), show="headings")
+    treeview.heading("Ch", text="Ch")
+    treeview.column("Ch", width=40)
     treeview.heading("ID", text="ID")
     treeview.heading("Length", text="Length")
     treeview.heading("Data", text="Data")
     treeview.heading("Cycle Time", text="Cycle Time (ms)")
+    treeview.heading("Min", text="Min (ms)")
+    treeview.heading("Max", text="Max (ms)")
+    treeview.heading("Mean", text="Mean (ms)")
+    treeview.heading("Jitter", text="Jitter (ms)")
     treeview.heading("Count", text="Count")
 
     treeview.config(height=1200)
@@ -144,93 +178,149 @@ def init():
     log_file.write("internal events logged\n")
     log_file.write("// version 9.0.0\n")
     log_file.write("Begin Triggerblock " + f"{timestamp}\n")
-    start_time_logger = time.perf_counter()
+    start_time_logger = time.time()  # Same clock as the receive timestamps of the messages
     log_file.write(f"   0.000000" + " Start of measurement\n")
 
+    # Call function start_log_writer()
+    ASC_logger.start_log_writer(log_file, start_time_logger)
 
 
 
 
-# Function to format message to put in logger file
-def format_message_for_log_file(message, start_time_logger):
-    timestamp = time.perf_counter() - start_time_logger
-    hex_data = ' '.join([f"{byte:02X}" for byte in message.data])
-    message_channel = message.channel + 1
-    ID_for_log_file = f'{message.arbitration_id:08X}x'
 
-    return f"{timestamp:.6f} {message_channel}  {ID_for_log_file}       Rx   d {message.dlc} {hex_data}"
+# Function to estimate the number of bits of a frame on the bus (without stuff bits).
+# Standard frame: 47 bits + 8 bits per data byte, extended frame: 67 bits + 8 bits per data byte (interframe space included).
+def get_frame_bits(message):
+    if message.is_extended_id:
+        return 67 + 8 * message.dlc
+    return 47 + 8 * message.dlc
 
 
 
 # Function to receive CAN-messages and save
-def receive_can_messages(bus):
+def receive_can_messages(bus, channel_index):
     while True:
 
         message = bus.recv()
 
         if message is not None and not message.is_error_frame:
-            message_id = hex(message.arbitration_id)
+            # Drivers that name their channels (e.g. 'PCAN_USBBUS1' or 'can0') get the index of the channel in the configuration
+            if not isinstance(message.channel, int):
+                message.channel = channel_index
+
+            message_key = (channel_index, message.arbitration_id)
             with message_data_lock:
-                if message_id in message_data:
+                channel_bits[channel_index] += get_frame_bits(message)
+
+                slot = message_slots.get(message_key)
+                if slot is not None:
                     # Calculate cycle time based on timestamps
                     current_time = message.timestamp  # Use timestamp of message
-                    last_time = message_data[message_id]['last_time']
-                    cycle_time = current_time - last_time
-                    message_data[message_id]['last_time'] = current_time
-                    message_data[message_id]['cycle_time'] = round(cycle_time * 1000, 1)
-                    message_data[message_id]['count'] += 1
-                    message_data[message_id]['data'] = ' '.join(f"{byte:02X}" for byte in message.data)
-                    message_data[message_id]['length'] = len(message.data)
+                    cycle_time = (current_time - last_times[slot]) * 1000
+                    last_times[slot] = current_time
+                    cycle_times[slot] = cycle_time
+                    message_counts[slot] += 1
+                    message_payloads[slot] = message.data
+                    message_lengths[slot] = len(message.data)
+
+                    # Update min, max, mean and jitter of the cycle time (Welford's algorithm)
+                    number_of_cycles = message_counts[slot] - 1
+                    if number_of_cycles == 1:
+                        cycle_minimums[slot] = cycle_time
+                        cycle_maximums[slot] = cycle_time
+                    else:
+                        cycle_minimums[slot] = min(cycle_minimums[slot], cycle_time)
+                        cycle_maximums[slot] = max(cycle_maximums[slot], cycle_time)
+                    delta = cycle_time - cycle_means[slot]
+                    cycle_means[slot] += delta / number_of_cycles
+                    cycle_m2s[slot] += delta * (cycle_time - cycle_means[slot])
                 else:
-                    # Save message in dictionary
-                    message_data[message_id] = {
-                        'message': message,
-                        'last_time': message.timestamp,  # Gebruik de timestamp van het bericht
-                        'cycle_time': 0,
-                        'count': 1,
-                        'data': ' '.join(f"{byte:02X}" for byte in message.data),
-                        'length': len(message.data)
-                    }
-                # Write the CAN message to the log file
-                timestamp = datetime.datetime.now().strftime("%a %b %d %I:%M:%S.%f %p %Y")[:-6].lower()
-                message_for_log_file = format_message_for_log_file(message, start_time_logger)
-                log_file.write(f"   {message_for_log_file} \n")
+                    # Give the (channel, ID) a new slot
+                    message_slots[message_key] = len(message_counts)
+                    message_counts.append(1)
+                    message_lengths.append(len(message.data))
+                    message_payloads.append(message.data)
+                    last_times.append(message.timestamp)  # Gebruik de timestamp van het bericht
+                    cycle_times.append(0.0)
+                    cycle_minimums.append(0.0)
+                    cycle_maximums.append(0.0)
+                    cycle_means.append(0.0)
+                    cycle_m2s.append(0.0)
+
+                # Mark the row of this (channel, ID) to be updated in the next GUI refresh
+                dirty_message_keys.add(message_key)
+
+            # Put the CAN message in the queue of the log writer (outside of message_data_lock)
+            ASC_logger.write_message_to_log_file(message)
+
+
 
 
+# Function to get the row values of a (channel, ID) from its slot: channel (starting at 1 like in the log), ID, length, data,
+# cycle time, min, max, mean, jitter and count
+def get_row_values(message_key, slot):
+    number_of_cycles = message_counts[slot] - 1
+    jitter = math.sqrt(cycle_m2s[slot] / number_of_cycles) if number_of_cycles > 0 else 0.0
 
+    channel_index, arbitration_id = message_key
+    return (channel_index + 1, hex(arbitration_id), message_lengths[slot], message_payloads[slot].hex(' ').upper(), round(cycle_times[slot], 1), round(cycle_minimums[slot], 1),
+            round(cycle_maximums[slot], 1), round(cycle_means[slot], 1), round(jitter, 2), message_counts[slot])
 
-# Function to update GUI with CAN-messages
-def update_gui(treeview, message_id):
+
+
+# Function to update the bus load of every channel: bits on the bus since the last refresh compared to the bitrate
+def update_bus_load():
+    now = time.perf_counter()
     with message_data_lock:
-        message = message_data[message_id]['message']
-        message_length = message_data[message_id]['length']
-        message_data_text = message_data[message_id]['data']
-        cycle_time = message_data[message_id]['cycle_time']
-        count = message_data[message_id]['count']
+        bits = list(channel_bits)
 
-    for item in treeview.get_children():
-        if treeview.item(item, 'values')[0] == message_id:
-            current_values = treeview.item(item, 'values')
-            treeview.item(item, values=(message_id, message_length, message_data_text, cycle_time, count))
-            return
+    if bus_load_state['time'] is not None and now > bus_load_state['time']:
+        elapsed_time = now - bus_load_state['time']
+        bus_loads = [f"{config[1]}: {(bits[channel_index] - bus_load_state['bits'][channel_index]) / (elapsed_time * float(config[2])) * 100:.1f} %" for channel_index, config in enumerate(can_configurations)]
+        bus_load_label.config(text="Bus load: " + " | ".join(bus_loads))
 
-    treeview.insert('', 'end', values=(message_id, message_length, message_data_text, cycle_time, count))
+    bus_load_state['time'] = now
+    bus_load_state['bits'] = bits
 
 
 
-# Create a thread for periodically updating the GUI
-def update_gui_thread():
-    while True:
-        message_ids = list(message_data.keys())  # Create a copy of keys
-        for message_id in message_ids:
-            update_gui(treeview, message_id)
-        time.sleep(0.2)
+
+# Function to update GUI with CAN-messages. It runs on the tkinter thread and schedules itself again with root.after().
+# All (channel, ID) that received a message since the last refresh are updated in one batch; their rows are found in treeview_items.
+def update_gui():
+    # Take the changed IDs and their values in one go
+    with message_data_lock:
+        changed_rows = [(message_key, get_row_values(message_key, message_slots[message_key])) for message_key in dirty_message_keys]
+        dirty_message_keys.clear()
+
+    for message_key, row_values in changed_rows:
+        # Only touch rows of which count, data or cycle time changed
+        if rendered_rows.get(message_key) == row_values:
+            continue
+
+        item = treeview_items.get(message_key)
+        if item is None:
+            treeview_items[message_key] = treeview.insert('', 'end', values=row_values)
+        else:
+            treeview.item(item, values=row_values)
+
+        rendered_rows[message_key] = row_values
+
+    # Update the bus load about once per second
+    if bus_load_state['time'] is None or time.perf_counter() - bus_load_state['time'] >= 1.0:
+        update_bus_load()
+
+    root.after(gui_refresh_interval, update_gui)
 
 
 
 
 # If program exits, end the logger file
 def exit_handler():
+    # Write the messages that are still in the queue of the log writer
+    ASC_logger.stop_log_writer()
+    print(ASC_logger.format_log_counters())
+
     if log_file is not None and not log_file.closed:
         log_file.write("End TriggerBlock\n")
         log_file.close()
@@ -244,20 +334,19 @@ def main():
 
     # Create a thread for receiving CAN-messages
     receive_threads = []
-    for config in can_configurations:
+    for channel_index, config in enumerate(can_configurations):
         interface, channel, bitrate = config
         bus = can.interface.Bus(bustype=interface, channel=channel, bitrate=bitrate)
+        channel_bits.append(0)
 
-        receive_thread = threading.Thread(target=receive_can_messages, args=(bus,))
+        receive_thread = threading.Thread(target=receive_can_messages, args=(bus, channel_index))
         receive_thread.daemon = True
         receive_thread.start()
         receive_threads.append(receive_thread)
 
 
-    # Call function update_gui_thread in an other thread
-    update_thread = threading.Thread(target=update_gui_thread)
-    update_thread.daemon = True
-    update_thread.start()
+    # Call function update_gui(), it schedules itself on the tkinter thread
+    update_gui()
 
     # Register the exit handler
     atexit.register(exit_handler)
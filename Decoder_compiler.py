@@ -0,0 +1,283 @@
+"""
+Author: Jens Segaert
+Company: VDL Bus Roeselare
+
+Python version: 3.11.5
+
+Description: Generates a decode function for each subscribed message (only the signals of Field_parameters and their
+multiplexers). The payload is read once with int.from_bytes and every signal is a precomputed shift, mask, sign and
+scale/offset, instead of the generic decoding of cantools. The result is the same as cantools Message.decode():
+the same dictionary (order, int/float, NamedSignalValue of the choices) and the same DecodeError for wrong data sizes and
+unknown multiplexer values.
+Main writes the generated source to the DBC cache folder (Databases CAN\\Cache\\decoders_....py), so it is only generated
+again when a DBC file, the fields, cantools or this generator changes.
+
+Check against cantools with random payloads: python Decoder_compiler.py "Databases CAN\\*.dbc" --frames 1000
+"""
+
+import argparse
+import glob
+import os
+import random
+import struct
+import sys
+
+import cantools
+from cantools.database.conversion import BaseConversion, IdentityConversion
+from cantools.database.errors import DecodeError
+from cantools.database.namedsignalvalue import NamedSignalValue
+from cantools.database.utils import format_or
+
+
+
+generator_version = 1
+float_formats = {16: '<e', 32: '<f', 64: '<d'}
+
+
+
+# Function to add the code lines that decode one signal to decoded[signal name]
+def generate_signal_code(message, signal, lines, indent):
+    if signal.byte_order == 'little_endian':
+        payload_name = 'little'
+        shift = signal.start
+    else:
+        # Motorola start bit is the most significant bit in sawtooth numbering
+        payload_name = 'big'
+        shift = 8 * message.length - (8 * (signal.start // 8) + (7 - signal.start % 8) + signal.length)
+
+    if shift < 0 or shift + signal.length > 8 * message.length:
+        raise ValueError(f'signal {signal.name} does not fit in {message.length} bytes')
+
+    extract_expression = f'({payload_name} >> {shift}) & {(1 << signal.length) - 1:#x}' if shift else f'{payload_name} & {(1 << signal.length) - 1:#x}'
+    lines.append(f'{indent}raw = {extract_expression}')
+
+    if signal.is_float:
+        lines.append(f"{indent}raw = unpack('{float_formats[signal.length]}', raw.to_bytes({signal.length // 8}, 'little'))[0]")
+    elif signal.is_signed:
+        lines.append(f'{indent}raw -= (raw & {1 << (signal.length - 1):#x}) << 1')
+
+    # The same conversion as cantools, with the scale and offset as the same Python numbers (int or float)
+    conversion = BaseConversion.factory(scale=signal.scale, offset=signal.offset, choices=None, is_float=signal.is_float)
+    value_expression = 'raw' if isinstance(conversion, IdentityConversion) else f'raw * {conversion.scale!r} + {conversion.offset!r}'
+
+    if signal.choices:
+        choice_key = 'int(raw)' if signal.is_float else 'raw'
+        lines.append(f'{indent}choice = choices_{message.signals.index(signal)}.get({choice_key})')
+        lines.append(f'{indent}decoded[{signal.name!r}] = {value_expression} if choice is None else choice')
+    else:
+        lines.append(f'{indent}decoded[{signal.name!r}] = {value_expression}')
+
+
+
+# Function to add the code lines of a node of the multiplexer tree (like the codec tree of cantools): first the signals of the
+# node, then per multiplexer of the node the signals of its multiplexer value
+def generate_node_code(message, node_signals, lines, indent):
+    for signal in node_signals:
+        generate_signal_code(message, signal, lines, indent)
+
+    for multiplexer in node_signals:
+        if not multiplexer.is_multiplexer:
+            continue
+
+        child_signals = [signal for signal in message.signals if signal.multiplexer_signal == multiplexer.name]
+        child_ids = {multiplexer_id for signal in child_signals for multiplexer_id in (signal.multiplexer_ids or [])}
+        if multiplexer.choices:
+            child_ids.update(multiplexer.choices.keys())
+
+        # Multiplexer number like cantools: the number of the choice name, or int() of the value
+        if multiplexer.choices:
+            choice_numbers = {choice_number: multiplexer.conversion.choice_to_number(str(choice)) for choice_number, choice in multiplexer.choices.items()}
+            lines.append(f'{indent}multiplexer = decoded[{multiplexer.name!r}]')
+            lines.append(f'{indent}multiplexer_number = {choice_numbers!r}[multiplexer.value] if isinstance(multiplexer, NamedSignalValue) else int(multiplexer)')
+        else:
+            lines.append(f'{indent}multiplexer_number = int(decoded[{multiplexer.name!r}])')
+
+        # Multiplexer values with the same signals share one branch
+        branches = {}
+        for child_id in sorted(child_ids):
+            branch_signals = tuple(signal for signal in child_signals if signal.multiplexer_ids and child_id in signal.multiplexer_ids)
+            branches.setdefault(branch_signals, []).append(child_id)
+
+        keyword = 'if'
+        for branch_signals, branch_ids in branches.items():
+            condition = f'multiplexer_number == {branch_ids[0]}' if len(branch_ids) == 1 else f'multiplexer_number in {set(branch_ids)!r}'
+            lines.append(f'{indent}{keyword} {condition}:')
+            if branch_signals:
+                generate_node_code(message, branch_signals, lines, indent + '    ')
+            else:
+                lines.append(f'{indent}    pass')
+            keyword = 'elif'
+
+        error_text = f'expected multiplexer id {format_or(sorted(child_ids))}, but got '
+        if branches:
+            lines.append(f'{indent}else:')
+            lines.append(f'{indent}    raise DecodeError({error_text!r} + str(multiplexer_number))')
+        else:
+            lines.append(f'{indent}raise DecodeError({error_text!r} + str(multiplexer_number))')
+
+
+
+# Function to generate the source of the decode function of a message, as a factory make_decode_<number>(message) that returns it.
+# The factory gets the choices (NamedSignalValue objects) from the message, so the function returns the same objects as cantools.
+def generate_decoder_source(message, number):
+    if message.is_container:
+        raise ValueError(f'container message {message.name} is not supported')
+
+    little_endian_signals = any(signal.byte_order == 'little_endian' for signal in message.signals)
+    big_endian_signals = any(signal.byte_order == 'big_endian' for signal in message.signals)
+
+    lines = [f'# {message.name} (0x{message.frame_id:X}), {len(message.signals)} signals',
+             f'def make_decode_{number}(message):']
+    for signal_number, signal in enumerate(message.signals):
+        if signal.choices:
+            lines.append(f'    choices_{signal_number} = message.signals[{signal_number}].choices')
+
+    lines += [f'    def decode_{number}(data):',
+              f'        if len(data) != {message.length}:',
+              f'            if len(data) < {message.length}:',
+              f"                raise DecodeError(f'Wrong data size: {{len(data)}} instead of {message.length} bytes')",
+              f'            data = data[:{message.length}]']
+    if little_endian_signals:
+        lines.append("        little = int.from_bytes(data, 'little')")
+    if big_endian_signals:
+        lines.append("        big = int.from_bytes(data, 'big')")
+    lines.append('        decoded = {}')
+
+    generate_node_code(message, [signal for signal in message.signals if signal.multiplexer_signal is None], lines, '        ')
+
+    lines += ['        return decoded',
+              f'    return decode_{number}',
+              '', '']
+
+    return '\n'.join(lines)
+
+
+
+# Function to generate the source of a module with the decode functions of all messages.
+# Messages that can not be generated get no function (they are decoded by cantools).
+def generate_module_source(messages):
+    parts = [f'# Generated by Decoder_compiler.py (version {generator_version}, cantools {cantools.__version__}), do not edit', '', '']
+    for number, message in enumerate(messages):
+        try:
+            parts.append(generate_decoder_source(message, number))
+        except (ValueError, KeyError) as e:
+            print(f"Warning: no decode function for {message.name}, cantools is used: {e}")
+
+    return '\n'.join(parts)
+
+
+
+# Function to get the decode functions of messages: {message: function}. The source is read from cache_file_path if it exists,
+# otherwise it is generated and written there (and older generated files in the same folder are removed).
+def load_decoders(messages, cache_file_path=None):
+    source = None
+    if cache_file_path is not None and os.path.exists(cache_file_path):
+        try:
+            with open(cache_file_path, 'r') as cache_file:
+                source = cache_file.read()
+        except OSError as e:
+            print(f"Warning: decoder cache file could not be read: {e}")
+
+    if source is None:
+        source = generate_module_source(messages)
+
+        if cache_file_path is not None:
+            try:
+                cache_directory = os.path.dirname(cache_file_path)
+                os.makedirs(cache_directory, exist_ok=True)
+                for old_cache_file in os.listdir(cache_directory):
+                    if old_cache_file.startswith('decoders_') and old_cache_file != os.path.basename(cache_file_path):
+                        os.remove(os.path.join(cache_directory, old_cache_file))
+
+                # Write to a temporary file first, so an interrupted write never leaves a broken cache file
+                with open(cache_file_path + '.tmp', 'w') as cache_file:
+                    cache_file.write(source)
+                os.replace(cache_file_path + '.tmp', cache_file_path)
+
+            except OSError as e:
+                print(f"Warning: decoder cache file could not be written: {e}")
+
+    namespace = {'DecodeError': DecodeError, 'NamedSignalValue': NamedSignalValue, 'unpack': struct.unpack}
+    exec(compile(source, cache_file_path or '<decoders>', 'exec'), namespace)
+
+    return {message: namespace[f'make_decode_{number}'](message) for number, message in enumerate(messages) if f'make_decode_{number}' in namespace}
+
+
+
+# Function to make random payloads for a message: random bytes, and for multiplexed messages also valid multiplexer values
+def make_random_payloads(message, number_of_frames, random_generator):
+    payloads = [random_generator.randbytes(message.length) for frame in range(number_of_frames)]
+
+    multiplexed_signals = [signal for signal in message.signals if signal.multiplexer_ids]
+    for frame in range(0, number_of_frames, 2) if multiplexed_signals else []:
+        signal = random_generator.choice(multiplexed_signals)
+        try:
+            payloads[frame] = message.encode({**{s.name: 0 for s in message.signals}, signal.multiplexer_signal: signal.multiplexer_ids[0]}, strict=False)
+        except Exception:
+            pass
+
+    # Also a short and a long frame
+    if message.length:
+        payloads.append(payloads[0][:-1])
+    payloads.append(payloads[0] + b'\x00')
+
+    return payloads
+
+
+
+# Function to compare the generated decode functions with cantools for random payloads of all messages of a database.
+# Returns the number of compared frames and a list of differences.
+def check_database(db, number_of_frames, seed=1):
+    random_generator = random.Random(seed)
+    messages = [message for message in db.messages if not message.is_container]
+    decoders = load_decoders(messages)
+
+    number_of_compared_frames = 0
+    differences = []
+    for message in messages:
+        decoder = decoders.get(message)
+        if decoder is None:
+            differences.append(f'{message.name}: no decode function')
+            continue
+
+        for payload in make_random_payloads(message, number_of_frames, random_generator):
+            number_of_compared_frames += 1
+            results = []
+            for decode_function in (message.decode, decoder):
+                try:
+                    results.append(decode_function(payload))
+                except DecodeError as e:
+                    results.append(('DecodeError', str(e)))
+
+            expected, decoded = results
+            if decoded != expected or (isinstance(expected, dict) and (list(decoded) != list(expected) or
+                                                                       [type(value) for value in decoded.values()] != [type(value) for value in expected.values()])):
+                differences.append(f'{message.name} {payload.hex()}: {decoded!r} instead of {expected!r}')
+
+    return number_of_compared_frames, differences
+
+
+
+# Main function: check the generated decode functions against cantools
+def main():
+    parser = argparse.ArgumentParser(description="Compare the generated decode functions with cantools for random payloads.")
+    parser.add_argument("dbc_files", nargs="+", help="DBC files (wildcards allowed)")
+    parser.add_argument("--frames", type=int, default=1000, help="random frames per message (default: 1000)")
+    arguments = parser.parse_args()
+
+    number_of_differences = 0
+    for dbc_pattern in arguments.dbc_files:
+        for dbc_filename in glob.glob(dbc_pattern) or [dbc_pattern]:
+            db = cantools.database.load_file(dbc_filename, strict=False)
+            number_of_compared_frames, differences = check_database(db, arguments.frames)
+            number_of_differences += len(differences)
+            for difference in differences[:20]:
+                print(difference)
+            print(f'{dbc_filename}: {len(db.messages)} messages, {number_of_compared_frames} frames, {len(differences)} differences')
+
+    sys.exit(1 if number_of_differences else 0)
+
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+"""
+Author: Jens Segaert
+Company: VDL Bus Roeselare
+
+Python version: 3.11.5
+
+Description: Instrumentation of the hot path of Main: a counter and a latency histogram for each stage
+(receive, decode, limit check, log write, render and gui refresh).
+Latencies are counted in power-of-two buckets of microseconds, so recording a sample is a few integer operations and
+the memory is fixed. When enabled is False (default), the callers skip the timing, so it costs one attribute check.
+Every stage is recorded by one thread at a time (receive and decode under the ingest lock, log write in the log writer
+thread, render on the tkinter thread), so no lock is needed.
+"""
+
+import json
+import time
+
+
+
+enabled = False
+
+number_of_buckets = 32  # Bucket 0: < 1 us, bucket k: 2^(k-1) - 2^k us, the last bucket takes everything above
+max_receive_latency = 60.0  # Larger receive latencies (in seconds) mean the driver does not use the time since epoch
+
+stage_names = ('receive', 'decode', 'limit check', 'log write', 'render', 'gui refresh')
+
+# Per stage: [count, total time (s), max time (s), bucket counts]
+stage_histograms = {}
+
+
+
+# Function to clear the counters and histograms of all stages
+def reset():
+    for stage in stage_names:
+        stage_histograms[stage] = [0, 0.0, 0.0, [0] * number_of_buckets]
+
+
+
+# Function to switch on the instrumentation
+def enable():
+    global enabled
+
+    reset()
+    enabled = True
+
+
+
+# Function to record the latency (in seconds) of a stage. count > 1 records the same latency for several items (e.g. a batch).
+def record(stage, elapsed_time, count=1):
+    histogram = stage_histograms[stage]
+    histogram[0] += count
+    histogram[1] += elapsed_time * count
+    if elapsed_time > histogram[2]:
+        histogram[2] = elapsed_time
+
+    bucket = int(elapsed_time * 1e6).bit_length()
+    if bucket >= number_of_buckets:
+        bucket = number_of_buckets - 1
+    histogram[3][bucket] += count
+
+
+
+# Function to estimate a percentile (in us) from the buckets: the upper bound of the bucket that holds it, at most the max
+def get_percentile(histogram, percentile):
+    count, total_time, max_time, buckets = histogram
+    if count == 0:
+        return 0.0
+
+    rank = count * percentile / 100
+    cumulative_count = 0
+    for bucket, bucket_count in enumerate(buckets):
+        cumulative_count += bucket_count
+        if cumulative_count >= rank:
+            return min(float(2 ** bucket), max_time * 1e6)
+
+    return max_time * 1e6
+
+
+
+# Function to make a report (dictionary) of all stages, times in us
+def get_report():
+    report = {}
+    for stage, histogram in stage_histograms.items():
+        count, total_time, max_time, buckets = histogram
+        report[stage] = {
+            'count': count,
+            'mean_us': total_time / count * 1e6 if count else 0.0,
+            'p50_us': get_percentile(histogram, 50),
+            'p90_us': get_percentile(histogram, 90),
+            'p99_us': get_percentile(histogram, 99),
+            'max_us': max_time * 1e6,
+            'buckets_us': {(f'<{2 ** bucket}' if bucket == 0 else f'{2 ** (bucket - 1)}-{2 ** bucket}'): bucket_count
+                           for bucket, bucket_count in enumerate(buckets) if bucket_count}
+        }
+
+    return report
+
+
+
+# Function to make a text table of all stages (for the GUI panel and the console)
+def format_report():
+    lines = [f'{"stage":<12}{"count":>10}{"mean us":>10}{"p50 us":>10}{"p90 us":>10}{"p99 us":>10}{"max us":>10}']
+    for stage, values in get_report().items():
+        lines.append(f'{stage:<12}{values["count"]:>10}{values["mean_us"]:>10.1f}{values["p50_us"]:>10.0f}'
+                     f'{values["p90_us"]:>10.0f}{values["p99_us"]:>10.0f}{values["max_us"]:>10.0f}')
+
+    return '\n'.join(lines)
+
+
+
+# Function to write the report to a JSON-file
+def dump_report(file_path):
+    with open(file_path, 'w') as report_file:
+        json.dump({'time': time.strftime('%Y-%m-%d %H:%M:%S'), 'stages': get_report()}, report_file, indent=2)
+
+    print('Instrumentation report written to', file_path)
+
+
+
+reset()
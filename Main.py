@@ -15,16 +15,27 @@ A logger file is made meant for vector CANalyzer 9.0 in the folder "Log files".
 import cantools
 import os
 import can
-import tkinter as tk
-from threading import Thread
+from threading import Thread, Lock, Condition
 import json
 import time
-import queue
+import collections
 import cachetools
 import math
-from tkinter import filedialog
 import datetime
 import atexit
+import argparse
+import hashlib
+import pickle
+import signal
+import sys
+import ASC_logger
+import multiprocessing
+import bisect
+from array import array
+from cantools.database.namedsignalvalue import NamedSignalValue
+from cantools.database.errors import DecodeError
+import Instrumentation
+import Decoder_compiler
 
 
 
@@ -37,37 +48,138 @@ signal_value_counters = {}
 counter_labels = {}
 previous_values = {}
 bus_instances = []
-filtered_database = []
+full_bus_logging = False
+software_can_filters = None  # With full bus logging, the acceptance filters are applied after logging
+software_filter_results = {}  # Result of the software filters per (ID, extended)
+subscribed_messages = []
+message_lookup = None
 root = None
+log_file = None
 error_counter_text = None
+overflow_counter_text = None
 last_receive_time = time.time()
 
 message_counters = {}
 decoded_info = {}
 
+# Latest decoded value per field and the fields that changed since the last GUI refresh
+decoded_values = {}
+dirty_fields = set()
+decoded_values_lock = Lock()
+field_message_names = {}
+
+# Memo of the last payload per (channel, arbitration ID) with its field values: an unchanged payload is not decoded again and its
+# fields are not rendered again, only their counter (every counter_refresh_interval seconds).
+# Optional (decode_cache_size > 0): an LRU cache of (arbitration ID, payload) -> field values, for IDs that send a few payloads in turn.
+decode_memo = {}
+decode_cache = None
+decode_cache_size = 0
+decode_memo_statistics = {'frames': 0, 'memo_hits': 0, 'cache_hits': 0}
+unchanged_fields = set()
+# Frames (channel, arbitration ID, payload) that could not be decoded: each one is counted and printed once
+decode_error_frames = set()
+max_decode_error_frames = 10000
+counter_refresh_interval = 1.0
+counter_refresh_time = 0
+
+# Number of received frames per (channel, arbitration ID). Only process_can_message() uses it (under ingest_lock).
+frame_counters = {}
+
+# Receive threads per bus, their statistics and the lock around the processing of one message
+channel_statistics = {}
+ingest_lock = Lock()
+bus_receive_timeout = 0.1  # Seconds before recv() returns on a quiet bus
+channel_report_interval = 10.0  # Seconds between reports of the channel statistics
+
+# Parsed databases: in memory and on disk (folder 'Cache' in 'Databases CAN')
+dbc_cache = cachetools.LRUCache(maxsize=20)
+dbc_cache_directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Databases CAN", "Cache")
+message_decoders = {}  # Generated decode function per subscribed message (see Decoder_compiler), cached in the same folder
+
+# Bounded ingest buffer between the receive threads and the processing thread.
+# Policy if the buffer is full: 'block' (the receive thread waits), 'drop-oldest' or 'keep-latest' (a new frame replaces the waiting
+# frame of its ID, only frames of other IDs drop the oldest one). With keep-latest, the buffer holds slots ([message]) that can be replaced.
+ingest_buffer_size = 10000
+ingest_policy = 'block'
+ingest_policies = ('block', 'drop-oldest', 'keep-latest')
+ingest_batch_size = 1000  # Maximum number of messages the processing thread takes at once
+ingest_buffer = collections.deque()
+ingest_latest_messages = {}  # keep-latest: slot of the newest waiting message per (channel, ID)
+ingest_buffer_lock = Lock()
+ingest_not_empty = Condition(ingest_buffer_lock)
+ingest_not_full = Condition(ingest_buffer_lock)
+ingest_statistics = {'high_water_mark': 0, 'dropped': 0}
+
+# Decode worker processes (optional): one input queue per worker, frames are sharded by arbitration ID so the order per ID stays the same.
+# The decoded field values of a batch come back on one result queue.
+decode_workers = []
+decode_worker_queues = []
+decode_worker_batches = []
+decode_result_queue = None
+decode_worker_stop_timeout = 2.0  # Seconds to wait for a decode worker to stop
+decode_worker_counters = {'sent': 0, 'done': 0}  # Frames sent to and decoded by the workers
+loaded_dbc_filenames = []
+
+# History of every field: ring buffers (arrays of doubles) with the receive time and value of the last field_history_size samples.
+# For the samples that are older than the ring buffer, the min and max per second of the last hour (the longest time range of the
+# trend view) are kept as well. The memory is fixed: number of fields x (field_history_size x 16 + 3600 x 24) bytes, however long the session is.
+field_history_size = 16384
+field_histories = {}  # Per field: [times, values, next index, number of samples]
+history_slot_seconds = 1.0
+history_slot_count = 3600
+field_slot_histories = {}  # Per field: [slot numbers (time // history_slot_seconds), minimums, maximums]
+latest_sample_time = None
+
+# Trend view: time range (minutes), size of the plot (pixels) and refresh (milliseconds)
+trend_minutes_options = (1, 5, 15, 30, 60)
+trend_width = 800
+trend_height = 300
+trend_refresh_interval = 1000
+
 can_data_buffer = []
-can_data_queue = queue.Queue(maxsize=10000)
 channel_configurations = []
 received_messages = {}
 error_counter = 0
 global_msg_cnt = 0
 time_sleep_gui = 0.5  # GUI delay in seconds
+render_frame_budget = 0.05  # Maximum time in seconds to render changed fields per GUI refresh
+
+# State of the GUI refresh: rendered (value text, colour, channel, counter) per field and status of the status row
+rendered_values = {}
+rendered_status = {}
+prev_msg_cnt = 0
+constant_msg_cnt_time = 0
+channel_report_time = 0
+can_status = None
+
+# Fields that are out of their limits (headless mode)
+fields_out_of_limits = {}
 
+# JSON-file for the instrumentation report on exit (None: no report)
+instrumentation_file_path = None
+instrumentation_refresh_interval = 1000  # Refresh of the instrumentation panel in milliseconds
 
 
-def load_json():
+
+def load_json(json_filename=None):
     # Set current directory
-    current_directory = os.getcwd() + '\\Configuration files'
+    current_directory = os.path.join(os.getcwd(), 'Configuration files')
     print('directory_JSON-files:',current_directory)
 
-    # Search all JSON-files in folder
-    json_files = [f for f in os.listdir(current_directory) if f.endswith(".json")]
+    # Search all JSON-files in folder (not needed if the JSON-file is given on the command line)
+    json_files = [] if json_filename is not None else [f for f in os.listdir(current_directory) if f.endswith(".json")]
 
-    if len(json_files) == 1:
+    if json_filename is not None:
+        # JSON-file given on the command line
+        print('JSON-file:', json_filename)
+    elif len(json_files) == 1:
         # If there is only 1 JSON-file, load this immediately
-        json_filename = json_files[0]
+        json_filename = os.path.join(current_directory, json_files[0])
     else:
-        # Show GUI to choose JSON-file
+        # Show GUI to choose JSON-file (tkinter is only imported when it is needed)
+        import tkinter as tk
+        from tkinter import filedialog
+
         root = tk.Tk()
         root.withdraw()  # Hide window GUI
 
@@ -88,27 +200,81 @@ def load_json():
 
 
 
+# Function to load a database: from the cache in memory, else from the cache on disk, else by parsing the dbc file
 def load_data_from_dbc(filename, cache):
-    # Add caching before loading data from dbc
-    if filename in cache:
-        return cache[filename]
+    cache_key = get_dbc_cache_key(filename)
+    if cache_key in cache:
+        return cache[cache_key]
     else:
-        data = load_data_from_file(filename)
-        cache[filename] = data
+        data = load_data_from_file(filename, cache_key)
+        cache[cache_key] = data
         return data
 
 
 
-def load_data_from_file(filename):
-    return f"Data from file: {filename}"
+# Function to make the start of the cache file names of a dbc file: file name and a hash of its absolute path,
+# so dbc files with the same name in different folders have their own cache files.
+def get_dbc_cache_prefix(filename):
+    path_hash = hashlib.sha256(os.path.normcase(os.path.abspath(filename)).encode('utf-8')).hexdigest()[:8]
+
+    return f'{os.path.basename(filename)}_{path_hash}_'
+
+
+
+# Function to make the cache key of a dbc file: file name, hash of the path, hash of the content and cantools version.
+# If the file or cantools changes, the key changes and the old cache file is not used anymore.
+def get_dbc_cache_key(filename):
+    with open(filename, 'rb') as dbc_file:
+        file_hash = hashlib.sha256(dbc_file.read()).hexdigest()[:32]
+
+    return f'{get_dbc_cache_prefix(filename)}{file_hash}_cantools-{cantools.__version__}'
+
+
+
+# Function to load a parsed database from the cache on disk. If there is no valid cache file, parse the dbc file and save it.
+def load_data_from_file(filename, cache_key):
+    cache_file_path = os.path.join(dbc_cache_directory, cache_key + '.pickle')
+
+    if os.path.exists(cache_file_path):
+        try:
+            with open(cache_file_path, 'rb') as cache_file:
+                return pickle.load(cache_file)
+        except Exception as e:
+            print(f"Warning: DBC cache file could not be loaded, parsing {filename} again: {e}")
+
+    db = cantools.database.load_file(filename)
+
+    try:
+        os.makedirs(dbc_cache_directory, exist_ok=True)
+
+        # Remove cache files of older versions of this dbc file (the same path), and of the old name format without the hash of the path
+        old_name_start = os.path.basename(filename) + '_'
+        for old_cache_file in os.listdir(dbc_cache_directory):
+            old_name_format = old_cache_file.startswith(old_name_start) and old_cache_file[len(old_name_start) + 32:].startswith('_cantools-')
+            if (old_cache_file.startswith(get_dbc_cache_prefix(filename)) or old_name_format) and old_cache_file != cache_key + '.pickle':
+                os.remove(os.path.join(dbc_cache_directory, old_cache_file))
+
+        # Write to a temporary file first, so an interrupted write never leaves a broken cache file
+        temporary_file_path = cache_file_path + '.tmp'
+        with open(temporary_file_path, 'wb') as cache_file:
+            pickle.dump(db, cache_file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temporary_file_path, cache_file_path)
+
+    except OSError as e:
+        print(f"Warning: DBC cache file could not be written: {e}")
+
+    return db
 
 
 
 def database_list(databases, dbc_filenames, dbc_file_list):
     global database
     for dbc_filename in dbc_filenames:
+        # Paths in the JSON-files are written with Windows separators
+        if dbc_filename:
+            dbc_filename = dbc_filename.replace('\\', os.sep)
         if dbc_filename and os.path.exists(dbc_filename):
-            db = cantools.database.load_file(dbc_filename)
+            db = load_data_from_dbc(dbc_filename, dbc_cache)
             databases.append(db)
             print(f"Loaded DBC file: {dbc_filename}")
             dbc_file_list.append(dbc_filename)
@@ -119,7 +285,7 @@ def database_list(databases, dbc_filenames, dbc_file_list):
 
 
 
-def setup_can_buses(channel_configurations):
+def setup_can_buses(channel_configurations, can_filters=None):
     # Iterate over the channel configurations in the JSON
     for i in range(1, 20):
         interface_key = f"Interface{i}"
@@ -136,42 +302,115 @@ def setup_can_buses(channel_configurations):
 
     bus_instances = []
 
+    # Only the needed IDs are accepted, other messages are rejected by the driver (or by python-can if the hardware can not)
     for config in channel_configurations:
-        bus = can.interface.Bus(channel=config["channel"], bustype=config["interface"], bitrate=config["bitrate"])
+        bus = can.interface.Bus(channel=config["channel"], bustype=config["interface"], bitrate=config["bitrate"], can_filters=can_filters)
         bus_instances.append(bus)
 
     return bus_instances
 
 
 
-def filter_databases(databases):
-    # Make copy of databases
-    filtered_database = databases
+# Function to make the acceptance filters (python-can can_filters) for the IDs that are decoded.
+# J1939 messages with source address 0xFE in the database match every source address, so they get a mask without it.
+# Only source addresses below 50 are decoded, so these are split in 3 masks (0-31, 32-47 and 48-49).
+def build_can_filters(subscribed_messages):
+    can_filters = []
+    added_filters = set()
+
+    for db, message_dbc_file, subscribed_message in subscribed_messages:
+        if subscribed_message is None:
+            continue
+
+        if message_dbc_file.frame_id & 0xff == 0xfe:
+            pgn_id = message_dbc_file.frame_id & 0x1fffff00
+            id_masks = [(pgn_id, 0x1fffffe0), (pgn_id | 0x20, 0x1ffffff0), (pgn_id | 0x30, 0x1ffffffe)]
+        elif message_dbc_file.frame_id & 0xff < 50:
+            id_masks = [(message_dbc_file.frame_id, 0x1fffffff if message_dbc_file.is_extended_frame else 0x7ff)]
+        else:
+            continue
+
+        for can_id, can_mask in id_masks:
+            if (can_id, can_mask, message_dbc_file.is_extended_frame) not in added_filters:
+                added_filters.add((can_id, can_mask, message_dbc_file.is_extended_frame))
+                can_filters.append({"can_id": can_id, "can_mask": can_mask, "extended": message_dbc_file.is_extended_frame})
+
+    return can_filters
+
+
+
+# Function to check if a message passes python-can acceptance filters
+def matches_can_filters(arbitration_id, is_extended_id, can_filters):
+    if not can_filters:
+        return True
+
+    for can_filter in can_filters:
+        if "extended" in can_filter and can_filter["extended"] != is_extended_id:
+            continue
+        if (arbitration_id ^ can_filter["can_id"]) & can_filter["can_mask"] == 0:
+            return True
+
+    return False
+
+
+
+# Function to check if a received message passes the software filters (full bus logging). The result is kept per ID.
+def passes_software_filters(message):
+    key = (message.arbitration_id, message.is_extended_id)
+    result = software_filter_results.get(key)
+    if result is None:
+        result = matches_can_filters(message.arbitration_id, message.is_extended_id, software_can_filters)
+        software_filter_results[key] = result
+
+    return result
+
+
 
-    # Filter database (only save needed messages)
-    for h in filtered_database:
-        messages_to_remove = []
-        for message in h.messages:
-            signals_to_remove = []
+# Function to build the subscription index from Field_parameters: a list of (db, message, subscribed message) of every message that
+# carries a wanted signal. The subscribed message only has the signals of fields whose message qualifier matches (None if there are
+# none); build_message_lookup() indexes the list by ID. The loaded databases are not changed.
+def build_subscription_index(databases):
+    subscribed_messages = []
+
+    for db in databases:
+        for message in db.messages:
+            # Every message with a wanted signal name stays in the lookup, also if its name does not match the message qualifier
+            if not any(signal.name in field_message_names for signal in message.signals):
+                continue
+
+            signals = []
             for signal in message.signals:
-                if signal.name not in field_parameters:
-                    signals_to_remove.append(signal)
+                message_names = field_message_names.get(signal.name)
+                if message_names is not None and (message.name in message_names or '' in message_names):
+                    signals.append(signal)
+
+            subscribed_messages.append((db, message, create_subscribed_message(message, signals)))
 
-            for signal in signals_to_remove:
-                message.signals.remove(signal)
+    return subscribed_messages
 
-            # Mark message to be deleted
-            if not message.signals:
-                messages_to_remove.append(message)
 
-        # Delete marked messages out of database
-        for message in messages_to_remove:
-            h.messages.remove(message)
 
-    # Delete database objects
-    filtered_database = [h for h in filtered_database if h.messages]
+# Function to make a message with only the subscribed signals (and their multiplexers), so decoding skips all other signals
+def create_subscribed_message(message, signals):
+    if not signals:
+        return None
+
+    signals = list(signals)
+    signal_names = {signal.name for signal in signals}
 
-    return filtered_database
+    # Multiplexed signals can only be decoded together with their multiplexer signal
+    for signal in signals:
+        if signal.multiplexer_signal is not None and signal.multiplexer_signal not in signal_names:
+            signals.append(message.get_signal_by_name(signal.multiplexer_signal))
+            signal_names.add(signal.multiplexer_signal)
+
+    return cantools.database.can.Message(frame_id=message.frame_id,
+                                         name=message.name,
+                                         length=message.length,
+                                         signals=signals,
+                                         is_extended_frame=message.is_extended_frame,
+                                         is_fd=message.is_fd,
+                                         strict=False)
 
 
 
@@ -206,8 +445,10 @@ def put_min_max_in_dict():
 
 
 def create_gui():
-    global status_text, field_value_texts, field_parameters, data, signal_value_counters, counter_labels,previous_values, bus_instances, filtered_database, root, error_counter_text, message_names_field_parameters, channel_textboxes
+    global status_text, field_value_texts, field_parameters, data, signal_value_counters, counter_labels,previous_values, bus_instances, subscribed_messages, root, error_counter_text, overflow_counter_text, ingest_high_water_mark_text, ingest_dropped_text, message_names_field_parameters, channel_textboxes
 
+    # tkinter is only imported when the GUI is made, so the headless mode runs without it
+    import tkinter as tk
 
     root = tk.Tk()
     root.title("Display")
@@ -221,13 +462,49 @@ def create_gui():
     status_text = tk.Text(root, height=1, width=20, state="disabled")
     status_text.grid(row=0, column=1)
 
-    error_counter_label = tk.Label(root, text="Error cnt:")
-    error_counter_label.grid(row=0, column=2)
+    # Counters of the status row. They share columns 2 - 5 of row 0 (the other columns of row 0 have fields)
+    status_counters_frame = tk.Frame(root)
+    status_counters_frame.grid(row=0, column=2, columnspan=4)
+
+    error_counter_label = tk.Label(status_counters_frame, text="Error cnt:")
+    error_counter_label.pack(side="left")
 
-    error_counter_text = tk.Label(root, height=1, width=5)
-    error_counter_text.grid(row=0, column=3)
+    error_counter_text = tk.Label(status_counters_frame, height=1, width=5)
+    error_counter_text.pack(side="left")
     error_counter_text.config(text="0")
 
+    # High-water mark and drops of the ingest buffer
+    ingest_high_water_mark_label = tk.Label(status_counters_frame, text="Buf max:")
+    ingest_high_water_mark_label.pack(side="left")
+
+    ingest_high_water_mark_text = tk.Label(status_counters_frame, height=1, width=6)
+    ingest_high_water_mark_text.pack(side="left")
+    ingest_high_water_mark_text.config(text="0")
+
+    ingest_dropped_label = tk.Label(status_counters_frame, text="Buf drop:")
+    ingest_dropped_label.pack(side="left")
+
+    ingest_dropped_text = tk.Label(status_counters_frame, height=1, width=6)
+    ingest_dropped_text.pack(side="left")
+    ingest_dropped_text.config(text="0")
+
+    overflow_counter_label = tk.Label(status_counters_frame, text="Ovf cnt:")
+    overflow_counter_label.pack(side="left")
+
+    overflow_counter_text = tk.Label(status_counters_frame, height=1, width=5)
+    overflow_counter_text.pack(side="left")
+    overflow_counter_text.config(text="0")
+
+    # Button to open the trend view of the fields
+    trend_button = tk.Button(status_counters_frame, text="Trend", command=show_trend_panel)
+    trend_button.pack(side="left")
+
+    # Button to open the panel with the latency histograms (only when the instrumentation is switched on).
+    # It is in the status row, so it never covers a field (row 0 has fields from column 6 on).
+    if Instrumentation.enabled:
+        instrumentation_button = tk.Button(status_counters_frame, text="Instrumentation", command=show_instrumentation_panel)
+        instrumentation_button.pack(side="left")
+
     row1 = 1
     row2 = 0
     row3 = 0
@@ -337,21 +614,11 @@ def create_gui():
 
 
 
-def init():
-    global start_time_logger, log_file, status_text, field_value_texts, field_parameters, data, signal_value_counters, counter_labels,previous_values, bus_instances, filtered_database, root, error_counter_text, message_names_field_parameters, error_counter
+def init(replay_file_path=None, full_log=False, config_file_path=None, headless=False):
+    global decode_cache, full_bus_logging, software_can_filters, start_time_logger, log_file, status_text, field_value_texts, field_parameters, data, signal_value_counters, counter_labels,previous_values, bus_instances, subscribed_messages, message_lookup, root, error_counter_text, message_names_field_parameters, error_counter
 
     # Call function load_json()
-    data = load_json()
-
-    # Caching
-    cache = cachetools.LRUCache(maxsize=500)
-
-    # Use function to load data
-    data1 = load_data_from_dbc("file1.dbc", cache)
-    data2 = load_data_from_dbc("file2.dbc", cache)
-
-    cached_data1 = load_data_from_dbc("file1.dbc", cache)
-    cached_data2 = load_data_from_dbc("file2.dbc", cache)
+    data = load_json(config_file_path)
 
     # Get paths to DBC files from JSON-data
     dbc_filenames = [data.get(f"Locatie Database CAN{i}") for i in range(1, 20) if data.get(f"Locatie Database CAN{i}")]
@@ -363,9 +630,7 @@ def init():
 
     # Call function database_list()
     dbc_file_list, databases = database_list(databases, dbc_filenames, dbc_file_list)
-
-    # Call function setup_can_buses()
-    bus_instances = setup_can_buses(channel_configurations)
+    loaded_dbc_filenames[:] = dbc_file_list
 
     # Get field_parameters from data JSON-file
     dbc_filename = data.get("Locatie Database CAN")
@@ -374,14 +639,49 @@ def init():
     # Get names of signals field_parameters
     message_names_field_parameters = [field_data[f"Field{i}"]["message"] for i, field_data in enumerate(data.get("Field_parameters"), start=1)]
 
-    # Call function filter_databases()
-    filtered_database = filter_databases(databases)
+    # Message names allowed per field ('' means any message)
+    for field_parameter, message_name in zip(field_parameters, message_names_field_parameters):
+        field_message_names.setdefault(field_parameter, set()).add(message_name)
+
+    # Call function create_field_histories()
+    create_field_histories()
+
+    # LRU cache of decoded payloads (optional)
+    if decode_cache_size > 0:
+        decode_cache = cachetools.LRUCache(maxsize=decode_cache_size)
+
+    # Call function build_subscription_index()
+    subscribed_messages = build_subscription_index(databases)
+
+    # Call function build_message_lookup()
+    message_lookup = build_message_lookup(subscribed_messages)
+
+    # Call function compile_message_decoders()
+    message_decoders.clear()
+    message_decoders.update(compile_message_decoders(subscribed_messages, dbc_file_list))
+
+    # Call function setup_can_buses() with the filters of build_can_filters() (not needed when a log file is replayed).
+    # To log all messages on the bus, the buses are opened without filters and the filters are applied after logging.
+    if replay_file_path is None:
+        can_filters = build_can_filters(subscribed_messages)
+        print(f"Acceptance filters: {len(can_filters)}")
+        full_bus_logging = full_log
+        if full_bus_logging:
+            software_can_filters = can_filters or None
+            bus_instances = setup_can_buses(channel_configurations)
+        else:
+            bus_instances = setup_can_buses(channel_configurations, can_filters or None)
 
     # Call function put_min_max_in_dict()
     put_min_max_in_dict()
 
-    # Call function create_gui()
-    create_gui()
+    # Call function create_gui() (not in headless mode)
+    if not headless:
+        create_gui()
+
+    # A replayed log file is not logged again
+    if replay_file_path is not None:
+        return
 
     # Create log file path en open file
     log_file_path = create_log_file_path()
@@ -396,264 +696,948 @@ def init():
     log_file.write("internal events logged\n")
     log_file.write("// version 9.0.0\n")
     log_file.write("Begin Triggerblock " + f"{timestamp}\n")
-    start_time_logger = time.perf_counter()
+    start_time_logger = time.time()  # Same clock as the receive timestamps of the messages
     log_file.write(f"   0.000000" +" Start of measurement\n")
 
+    # Call function start_log_writer()
+    ASC_logger.start_log_writer(log_file, start_time_logger)
 
 
 
-# Function to update the list of received messages through CAN-interface
-def update_list_received_messages(message, dict_recv_msg_cnt):
-    #print('\n in function update_list_received_messages(message, dict_recv_msg_cnt)')
 
-    id = message.arbitration_id
+# Function to count a received message. Returns the counter of its (channel, ID) key.
+def update_frame_counter(message):
+    key = (message.channel, message.arbitration_id)
+    message_counter = frame_counters.get(key, 0) + 1
+    frame_counters[key] = message_counter
 
-    if id not in dict_recv_msg_cnt:
-        list_received_messages.append(message)
-        dict_recv_msg_cnt[id] = 1
+    return message_counter
 
-    else:
-        # Overwrite message in list
-        for message_in_list in list_received_messages: # Loop in list
-            index = list_received_messages.index(message_in_list)  # Get index list value
-            if message_in_list.arbitration_id == id:   # If messages are the same
-                list_received_messages[index] = message  # Overwrite message with new message
-                break
 
-        # Update counter
-        message_counter = dict_recv_msg_cnt.get(id)
-        dict_recv_msg_cnt[id] = message_counter + 1
 
+# Function to process one received CAN-message: count it and decode it.
+# The processing thread (or the replay thread) calls this under ingest_lock, so the messages of all buses form one ordered stream.
+def process_can_message(message):
+    global error_counter, global_msg_cnt
 
+    try:
+        global_msg_cnt += 1
 
-# Function to format message to put in logger file
-def format_message_for_log_file(message, start_time_logger):
-    timestamp = time.perf_counter() - start_time_logger
-    hex_data = ' '.join([f"{byte:02X}" for byte in message.data])
-    message_channel = message.channel + 1
-    ID_for_log_file = f'{message.arbitration_id:08X}x'
+        if message.is_error_frame:
+            print('message.is_error_frame')
+            error_counter += 1
+        else:
+            # Time between the receive timestamp of the driver and the processing of the message
+            if Instrumentation.enabled:
+                receive_latency = time.time() - message.timestamp
+                if 0.0 <= receive_latency < Instrumentation.max_receive_latency:
+                    Instrumentation.record('receive', receive_latency)
 
-    return f"{timestamp:.6f} {message_channel}  {ID_for_log_file}       Rx   d {message.dlc} {hex_data}"
+            message_counter = update_frame_counter(message)
 
+            # Decode the new frame once, unless its payload did not change, and keep the decoded signal values (or give it to the decode worker of its ID)
+            if (message.arbitration_id & 0xFF) < 50:
+                if decode_worker_queues:
+                    decode_worker_batches[message.arbitration_id % len(decode_worker_queues)].append(
+                        (message.arbitration_id, message.is_extended_id, bytes(message.data), message.channel, message_counter, message.timestamp))
+                else:
+                    field_values, unchanged = decode_with_memo(message_lookup, message)
+                    update_decoded_values(field_values, message, message_counter, unchanged)
 
+    # Error handling
+    except Exception as e:
+        error_counter += 1
+        print(f'{e}')
+
+
+
+# Function to check if an error of the driver means that its receive queue overflowed
+def is_driver_overflow(error):
+    error_text = str(error).lower()
+    return 'overrun' in error_text or 'overflow' in error_text or 'queue_is_full' in error_text
 
 
-# Function to receive can data. This data is put in a list and in a logger file.
-def receive_and_process_can_data():
-    #print('\n in function receive_and_process_can_data()')
-    global list_received_messages, dict_recv_msg_cnt, error_counter, global_msg_cnt
-    list_received_messages = []
-    dict_recv_msg_cnt = {}
-    message_counter = 0
-    while True:
-        try:
-            for bus in bus_instances:
 
-                message = bus.recv()
-                global_msg_cnt += 1
+# Function to check if an error frame reports a controller receive overflow (SocketCAN error class CAN_ERR_CRTL)
+def is_overflow_error_frame(message):
+    return bool(message.arbitration_id & 0x04) and len(message.data) > 1 and bool(message.data[1] & 0x01)
 
-                if message.is_error_frame:
-                    print('message.is_error_frame')
-                    error_counter += 1
-                elif message is not None:
-                    update_list_received_messages(message, dict_recv_msg_cnt)
 
-                    # Write the CAN message to the log file
-                    timestamp = datetime.datetime.now().strftime("%a %b %d %I:%M:%S.%f %p %Y")[:-6].lower()
-                    message_for_log_file = format_message_for_log_file(message, start_time_logger)
-                    log_file.write(f"   {message_for_log_file} \n")
 
+# Function to receive CAN-messages of one bus. Every bus has its own thread, so a quiet bus never stalls a busy one.
+def receive_from_bus(bus, channel_index):
+    global error_counter
+    statistics = channel_statistics[channel_index]
+    window_start_time = time.perf_counter()
+    window_start_frames = 0
+
+    while True:
+        try:
+            message = bus.recv(timeout=bus_receive_timeout)
 
         # Error handling
         except Exception as e:
-            error_counter += 1
-            print(f'{e}')
+            with ingest_lock:
+                error_counter += 1
+                if is_driver_overflow(e):
+                    statistics['overflows'] += 1
+            print(f'{statistics["name"]}: {e}')
             continue
 
+        if message is not None:
+            # Drivers that name their channels (e.g. 'PCAN_USBBUS1' or 'can0') get the index of the channel in the configuration
+            if not isinstance(message.channel, int):
+                message.channel = channel_index
+
+            statistics['frames'] += 1
+            if message.is_error_frame and is_overflow_error_frame(message):
+                statistics['overflows'] += 1
+
+            # Every frame goes to the log writer, also if the ingest buffer drops it
+            if log_file is not None and not message.is_error_frame:
+                ASC_logger.write_message_to_log_file(message)
+
+            # With full bus logging, only the messages that pass the acceptance filters are decoded
+            if software_can_filters is None or message.is_error_frame or passes_software_filters(message):
+                put_in_ingest_buffer(message)
+
+        # Update the throughput of this channel about once per second
+        now = time.perf_counter()
+        if now - window_start_time >= 1.0:
+            statistics['frames_per_second'] = (statistics['frames'] - window_start_frames) / (now - window_start_time)
+            window_start_time = now
+            window_start_frames = statistics['frames']
+
+
+
+# Function to put a received message in the ingest buffer. If the buffer is full, ingest_policy decides what happens.
+def put_in_ingest_buffer(message):
+    with ingest_buffer_lock:
+        key = (message.channel, message.arbitration_id)
+
+        if len(ingest_buffer) >= ingest_buffer_size:
+            if ingest_policy == 'block':
+                while len(ingest_buffer) >= ingest_buffer_size:
+                    ingest_not_full.wait()
+            elif ingest_policy == 'keep-latest' and not message.is_error_frame and key in ingest_latest_messages:
+                # A frame of this ID is still waiting: it is replaced by the newer one
+                ingest_latest_messages[key][0] = message
+                ingest_statistics['dropped'] += 1
+                return
+            else:
+                # Drop the oldest waiting message
+                oldest_message = ingest_buffer.popleft()
+                if ingest_policy == 'keep-latest':
+                    remove_latest_slot(oldest_message)
+                ingest_statistics['dropped'] += 1
+
+        if ingest_policy == 'keep-latest':
+            slot = [message]
+            ingest_buffer.append(slot)
+            if not message.is_error_frame:
+                ingest_latest_messages[key] = slot
+        else:
+            ingest_buffer.append(message)
+        if len(ingest_buffer) > ingest_statistics['high_water_mark']:
+            ingest_statistics['high_water_mark'] = len(ingest_buffer)
+
+        ingest_not_empty.notify()
+
+
+
+# Function to remove a slot that leaves the ingest buffer (keep-latest) from ingest_latest_messages, if it is the newest slot of its ID.
+# Returns the message in the slot.
+def remove_latest_slot(slot):
+    message = slot[0]
+    key = (message.channel, message.arbitration_id)
+    if ingest_latest_messages.get(key) is slot:
+        del ingest_latest_messages[key]
+
+    return message
+
+
+
+# Function to take the waiting messages (at most ingest_batch_size) out of the ingest buffer. Waits if the buffer is empty.
+def take_from_ingest_buffer():
+    with ingest_buffer_lock:
+        while not ingest_buffer:
+            ingest_not_empty.wait()
+
+        messages = []
+        while ingest_buffer and len(messages) < ingest_batch_size:
+            message = ingest_buffer.popleft()
+            if ingest_policy == 'keep-latest':
+                message = remove_latest_slot(message)
+            messages.append(message)
+
+        ingest_not_full.notify_all()
+
+    return messages
+
+
+
+# Function of the processing thread: process the messages of the ingest buffer in the order they were received
+def process_ingest_buffer():
+    while True:
+        messages = take_from_ingest_buffer()
+
+        with ingest_lock:
+            for message in messages:
+                process_can_message(message)
+
+            send_decode_worker_batches()
+
+
+
+# Function to make a report of the ingest buffer
+def format_ingest_statistics():
+    return f'buffer ({ingest_policy}): {len(ingest_buffer)}/{ingest_buffer_size}, max {ingest_statistics["high_water_mark"]}, {ingest_statistics["dropped"]} dropped'
+
+
+
+# Function to start the processing thread and one receive thread per configured bus
+def start_receive_threads():
+    receive_threads = []
+
+    processing_thread = Thread(target=process_ingest_buffer)
+    processing_thread.daemon = True
+    processing_thread.start()
+
+    for channel_index, (bus, config) in enumerate(zip(bus_instances, channel_configurations)):
+        channel_statistics[channel_index] = {
+            'name': f'{config["interface"]} {config["channel"]}',
+            'frames': 0,
+            'frames_per_second': 0.0,
+            'overflows': 0
+        }
+
+        receive_thread = Thread(target=receive_from_bus, args=(bus, channel_index))
+        receive_thread.daemon = True
+        receive_thread.start()
+        receive_threads.append(receive_thread)
+
+    return receive_threads
+
+
+
+# Function to make a report of the throughput and driver-queue overflows per channel
+def format_channel_statistics():
+    return ' | '.join(f'{statistics["name"]}: {statistics["frames_per_second"]:.0f} msg/s, {statistics["overflows"]} ovf' for statistics in channel_statistics.values())
+
+
+
+
+# Function to replay a log file (made by this script or CAN-viewer) through the same pipeline as received messages.
+# speed is the factor on real time (e.g. 0.5 - 10), 0 replays the messages as fast as possible.
+def replay_log_file(replay_file_path, speed):
+    statistics = channel_statistics[0]
+    replay_start_time = time.perf_counter()
+    window_start_time = replay_start_time
+    window_start_frames = 0
+    first_timestamp = None
+
+    for message in can.ASCReader(replay_file_path):
+        if first_timestamp is None:
+            first_timestamp = message.timestamp
+
+        # Wait until the message is due in scaled real time
+        if speed > 0:
+            delay = replay_start_time + (message.timestamp - first_timestamp) / speed - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+
+        statistics['frames'] += 1
+        with ingest_lock:
+            process_can_message(message)
+
+            # Frames for the decode workers are sent in batches, or right away if the replay runs in real time
+            if speed > 0 or statistics['frames'] % ingest_batch_size == 0:
+                send_decode_worker_batches()
+
+        now = time.perf_counter()
+        if now - window_start_time >= 1.0:
+            statistics['frames_per_second'] = (statistics['frames'] - window_start_frames) / (now - window_start_time)
+            window_start_time = now
+            window_start_frames = statistics['frames']
+
+    with ingest_lock:
+        send_decode_worker_batches()
+
+    elapsed_time = time.perf_counter() - replay_start_time
+    print(f'Replay finished: {statistics["frames"]} messages in {elapsed_time:.3f} s ({statistics["frames"] / max(elapsed_time, 1e-9):.0f} msg/s)')
+
+
+
+# Function to start the thread that replays a log file
+def start_replay_thread(replay_file_path, speed):
+    channel_statistics[0] = {
+        'name': f'replay {os.path.basename(replay_file_path)}',
+        'frames': 0,
+        'frames_per_second': 0.0,
+        'overflows': 0
+    }
+
+    replay_thread = Thread(target=replay_log_file, args=(replay_file_path, speed))
+    replay_thread.daemon = True
+    replay_thread.start()
+
+    return replay_thread
+
+
+
+
+# Function to build a lookup index of the subscribed messages: an exact-ID map and a masked-PGN map for the J1939 0xFE wildcard.
+# Each entry keeps its position in the databases, so the first database (and first message) still wins.
+def build_message_lookup(subscribed_messages):
+    exact_ids = {}
+    masked_ids = {}
+
+    for position, (db, message_dbc_file, subscribed_message) in enumerate(subscribed_messages):
+        if message_dbc_file.frame_id & 0xff == 0xfe:
+            masked_ids.setdefault(message_dbc_file.frame_id & 0xffffff00, (position, db, subscribed_message))
+        else:
+            exact_ids.setdefault(message_dbc_file.frame_id, (position, db, subscribed_message))
+
+    return exact_ids, masked_ids
+
+
+
+# Function to get the generated decode functions of the subscribed messages. The source is cached in the DBC cache folder under
+# a name made of the DBC cache keys and the fields, so it is only generated again when one of them changes.
+def compile_message_decoders(subscribed_messages, dbc_filenames):
+    cache_key = hashlib.sha256(json.dumps([
+        Decoder_compiler.generator_version,
+        [get_dbc_cache_key(dbc_filename) for dbc_filename in dbc_filenames],
+        sorted((field_parameter, sorted(message_names)) for field_parameter, message_names in field_message_names.items())
+    ]).encode('utf-8')).hexdigest()[:32]
+
+    messages = [subscribed_message for db, message, subscribed_message in subscribed_messages if subscribed_message is not None]
+
+    try:
+        return Decoder_compiler.load_decoders(messages, os.path.join(dbc_cache_directory, f'decoders_{cache_key}.py'))
+    except Exception as e:
+        print(f"Warning: decode functions could not be generated, cantools is used: {e}")
+        return {}
+
+
+
+# Function to find the database and message for an arbitration ID in the lookup index
+def find_message(message_lookup, arbitration_id):
+    exact_ids, masked_ids = message_lookup
+
+    found = exact_ids.get(arbitration_id)
+    masked_match = masked_ids.get(arbitration_id & 0xffffff00)
+
+    # If both maps match, take the one that comes first in the databases
+    if masked_match is not None and (found is None or masked_match[0] < found[0]):
+        found = masked_match
+
+    if found is None:
+        return None, None
+
+    return found[1], found[2]
 
 
 
 # Decode CAN-message with database-CAN specified in JSON-file
-def decode_can_message(databases, can_message):
-    global status_text, field_value_texts, field_parameters, data, signal_value_counters, counter_labels, previous_values, bus_instances, filtered_database, root, error_counter_text, message_names_field_parameters
+def decode_can_message(message_lookup, can_message):
+    global status_text, field_value_texts, field_parameters, data, signal_value_counters, counter_labels, previous_values, bus_instances, subscribed_messages, root, error_counter_text, message_names_field_parameters
 
     try:
-        start_time = time.perf_counter()
-        if databases is None:
+        if Instrumentation.enabled:
+            start_time = time.perf_counter()
+        if message_lookup is None:
             return None, None
 
-        found_message = None
-
-        for db in databases:
-            for message_dbc_file in db.messages:
-                  if message_dbc_file.frame_id & 0xff == 0xfe:
-                      if (message_dbc_file.frame_id & 0xffffff00) == (can_message.arbitration_id & 0xffffff00):
-                        found_message = message_dbc_file
-                        break
-                  else:
-                      if (message_dbc_file.frame_id) == (can_message.arbitration_id):
-                        found_message = message_dbc_file
-                        break
-            if found_message:
-                break
+        db, found_message = find_message(message_lookup, can_message.arbitration_id)
 
         if not found_message:
             return None, None
 
-        decoded_message = db.decode_message(found_message.name, can_message.data)
+        # Only the subscribed signals are decoded, with the generated decode function of the message (cantools if there is none)
+        decoder = message_decoders.get(found_message)
+        decoded_message = decoder(can_message.data) if decoder is not None else found_message.decode(can_message.data)
         name_of_found_message = found_message.name
 
-        end_time = time.perf_counter()
-        elapsed_time = end_time - start_time
-        #print('elapsed_time_decode_can_message:', elapsed_time*1000)
+        if Instrumentation.enabled:
+            Instrumentation.record('decode', time.perf_counter() - start_time)
 
     except AttributeError:
-        return None
+        return None, None
+
+    # Frame that does not fit the database (too short, unknown multiplexer value): no signal values
+    except DecodeError as e:
+        count_decode_error(can_message, e)
+        return None, None
 
     return decoded_message, name_of_found_message
 
 
 
+# Function to count a frame that could not be decoded, once per (channel, ID, payload), so a stuck malformed frame is not
+# counted and printed at the rate of the bus
+def count_decode_error(can_message, error):
+    global error_counter
+
+    error_key = (can_message.channel, can_message.arbitration_id, bytes(can_message.data))
+    if error_key in decode_error_frames:
+        return
+
+    # The set is emptied when it gets large (many different malformed payloads), so its memory stays bounded
+    if len(decode_error_frames) >= max_decode_error_frames:
+        decode_error_frames.clear()
+    decode_error_frames.add(error_key)
+
+    error_counter += 1
+    print(f'{can_message.arbitration_id:X}: {error}')
+
+
+
+
+# Function to check a value against the min-value and max-value of its field. Returns True if the value is out of limits.
+def is_out_of_limits(field_parameter, current_value):
+    if Instrumentation.enabled:
+        start_time = time.perf_counter()
+
+    out_of_limits = False
+    if current_value is not None and isinstance(current_value, (float, int)):
+        min_value, max_value = min_max_values.get(field_parameter, (-math.inf, math.inf))
+        out_of_limits = current_value < min_value or current_value > max_value
+
+    if Instrumentation.enabled:
+        Instrumentation.record('limit check', time.perf_counter() - start_time)
+
+    return out_of_limits
+
 
-# Update textbox color based on min-values and max-values
-def update_textbox_color(field_parameter, current_value, min_value, max_value):
 
-    start_time = time.time()
-    value_text_widget = field_value_texts[field_parameter]
 
-    if current_value is None:
-        value_text_widget.config(bg='white')
+# Function to get the decoded signal values of a frame that belong to a field (with a matching message name)
+def get_field_values(decoded_message, name_of_found_message):
+    field_values = []
+    for field_parameter, current_value in decoded_message.items():
+        message_names = field_message_names.get(field_parameter)
+        if message_names is not None and (name_of_found_message in message_names or '' in message_names):
+            field_values.append((field_parameter, current_value))
 
-    elif isinstance(current_value, float or int) is not True:
-        value_text_widget.config(bg='white')
+    return field_values
 
+
+
+# Function to get the field values of a message: from the memo if the payload is the same as the previous frame of this channel and ID,
+# else from the LRU cache (if any), else decoded. Returns (list of (field, value), unchanged).
+def decode_with_memo(lookup, message):
+    memo_key = (message.channel, message.arbitration_id)
+    payload = bytes(message.data)
+    decode_memo_statistics['frames'] += 1
+
+    memo = decode_memo.get(memo_key)
+    if memo is not None and memo[0] == payload:
+        decode_memo_statistics['memo_hits'] += 1
+        return memo[1], True
+
+    field_values = decode_cache.get((message.arbitration_id, payload)) if decode_cache is not None else None
+    if field_values is not None:
+        decode_memo_statistics['cache_hits'] += 1
     else:
-        if current_value < min_value or current_value > max_value:
-            value_text_widget.config(bg='red')
-        else:
-            value_text_widget.config(bg='white')
+        decoded, name_of_found_message = decode_can_message(lookup, message)
+        field_values = get_field_values(decoded, name_of_found_message) if decoded is not None else []
+        if decode_cache is not None:
+            decode_cache[(message.arbitration_id, payload)] = field_values
 
-    end_time = time.time()
-    elapsed_time = end_time - start_time
-    #print('elapsed_time_utc:', elapsed_time*1000)
+    decode_memo[memo_key] = (payload, field_values)
+    return field_values, False
 
 
 
+# Function to get the hit rates of the decode memo (and LRU cache) as text
+def format_decode_memo_statistics():
+    frames = decode_memo_statistics['frames']
+    memo_hits = decode_memo_statistics['memo_hits']
+    text = f'decode memo: {memo_hits / frames:.1%} of {frames} frames unchanged' if frames else 'decode memo: 0 frames'
 
-# Function to update signal values, channel values and counters in the GUI.
-def update_gui_values(decoded_message, name_of_found_message, id, message):
-    #print('\n in function update_signal_values(decoded_message, name_of_found_message)')
-    global status_text, field_value_texts, field_parameters, data, signal_value_counters, counter_labels, previous_values, bus_instances, filtered_database, root, error_counter_text, message_names_field_parameters
+    if decode_cache_size > 0:
+        cache_lookups = frames - memo_hits
+        cache_hit_rate = decode_memo_statistics['cache_hits'] / cache_lookups if cache_lookups else 0.0
+        text += f', cache ({decode_cache_size}): {cache_hit_rate:.1%} hits'
 
-    start_time = time.perf_counter()
+    return text
+
+
+
+# Function to store the decoded signal values of a new frame. Only the fields in this frame with a new value are marked dirty for the GUI.
+def update_decoded_values(field_values, message, counter_value, unchanged=False):
+    with decoded_values_lock:
+        for field_parameter, current_value in field_values:
+            store_field_value(field_parameter, current_value, message.channel, counter_value, message.timestamp, unchanged)
+
+
+
+# Function to store the value of a field (called under decoded_values_lock). If the frame has the same payload as the previous frame
+# of its channel and ID and the field still has this value, only the counter is new: the field is not rendered again now.
+def store_field_value(field_parameter, current_value, channel_value, counter_value, timestamp, unchanged):
+    stored_value = decoded_values.get(field_parameter)
+    if unchanged and stored_value is not None and stored_value[1] == channel_value and stored_value[0] == current_value:
+        unchanged_fields.add(field_parameter)
+    else:
+        dirty_fields.add(field_parameter)
+
+    decoded_values[field_parameter] = (current_value, channel_value, counter_value)
+    append_field_history(field_parameter, current_value, timestamp)
+
+
+
+# Function to make the history ring buffer and the min/max per second of every field
+def create_field_histories():
+    for field_parameter in field_parameters:
+        if field_parameter not in field_histories:
+            field_histories[field_parameter] = [array('d', bytes(8 * field_history_size)), array('d', bytes(8 * field_history_size)), 0, 0]
+            field_slot_histories[field_parameter] = [array('d', [-1.0]) * history_slot_count, array('d', bytes(8 * history_slot_count)),
+                                                     array('d', bytes(8 * history_slot_count))]
+
+
+
+# Function to add a sample to the history of a field (called under decoded_values_lock).
+# Values of signals with choices are kept as their number, other values that are not numbers are not kept.
+def append_field_history(field_parameter, current_value, timestamp):
+    global latest_sample_time
+
+    if isinstance(current_value, NamedSignalValue):
+        current_value = current_value.value
+    if not isinstance(current_value, (int, float)):
+        return
+
+    history = field_histories[field_parameter]
+    times, values, next_index, number_of_samples = history
+    times[next_index] = timestamp
+    values[next_index] = current_value
+    history[2] = (next_index + 1) % field_history_size
+    if number_of_samples < field_history_size:
+        history[3] = number_of_samples + 1
+
+    # Min and max of the time slot of the sample. A slot of more than an hour ago is started again.
+    slot_numbers, slot_minimums, slot_maximums = field_slot_histories[field_parameter]
+    slot_number = timestamp // history_slot_seconds
+    slot_index = int(slot_number) % history_slot_count
+    if slot_numbers[slot_index] != slot_number:
+        slot_numbers[slot_index] = slot_number
+        slot_minimums[slot_index] = current_value
+        slot_maximums[slot_index] = current_value
+    elif current_value < slot_minimums[slot_index]:
+        slot_minimums[slot_index] = current_value
+    elif current_value > slot_maximums[slot_index]:
+        slot_maximums[slot_index] = current_value
+
+    if latest_sample_time is None or timestamp > latest_sample_time:
+        latest_sample_time = timestamp
+
+
+
+# Function to get a copy of the history of a field, oldest sample first
+def get_field_history(field_parameter):
+    with decoded_values_lock:
+        times, values, next_index, number_of_samples = field_histories[field_parameter]
+        if number_of_samples < field_history_size:
+            return times[:number_of_samples], values[:number_of_samples]
+        return times[next_index:] + times[:next_index], values[next_index:] + values[:next_index]
+
+
+
+# Function to get the min and max per second of a field between start_time and end_time, as samples (two per second, in the middle
+# of the second) that can be put before the samples of get_field_history(). The second of end_time is left out.
+def get_field_slot_history(field_parameter, start_time, end_time):
+    times = array('d')
+    values = array('d')
+
+    with decoded_values_lock:
+        slot_numbers, slot_minimums, slot_maximums = field_slot_histories[field_parameter]
+        for slot_number in range(int(start_time // history_slot_seconds), int(end_time // history_slot_seconds)):
+            slot_index = slot_number % history_slot_count
+            if slot_numbers[slot_index] == slot_number:
+                slot_time = (slot_number + 0.5) * history_slot_seconds
+                times.extend((slot_time, slot_time))
+                values.extend((slot_minimums[slot_index], slot_maximums[slot_index]))
+
+    return times, values
+
+
+
+# Function to downsample samples between start_time and end_time to number_of_buckets buckets.
+# Every bucket keeps its min and max, so peaks stay visible however many samples there are. Returns (bucket, min, max) per bucket.
+def downsample_min_max(times, values, start_time, end_time, number_of_buckets):
+    bucket_minimums = [None] * number_of_buckets
+    bucket_maximums = [None] * number_of_buckets
+    bucket_width = (end_time - start_time) / number_of_buckets
+
+    # The samples are in order of time, so the first sample in the time range is found with bisect
+    for index in range(bisect.bisect_left(times, start_time), len(times)):
+        sample_time = times[index]
+        if sample_time > end_time:
+            break
+
+        value = values[index]
+        bucket = min(int((sample_time - start_time) / bucket_width), number_of_buckets - 1)
+        if bucket_minimums[bucket] is None:
+            bucket_minimums[bucket] = value
+            bucket_maximums[bucket] = value
+        elif value < bucket_minimums[bucket]:
+            bucket_minimums[bucket] = value
+        elif value > bucket_maximums[bucket]:
+            bucket_maximums[bucket] = value
+
+    return [(bucket, bucket_minimums[bucket], bucket_maximums[bucket]) for bucket in range(number_of_buckets) if bucket_minimums[bucket] is not None]
+
+
+
+# Function to make the points of the trend line of a field over the last time_range seconds (up to the newest sample of all fields).
+# Where the ring buffer does not go back far enough, the min and max per second are used.
+# Returns the canvas coordinates [x1, y1, x2, y2, ...] and the min and max value in the time range.
+def get_trend_points(field_parameter, time_range, width, height):
+    if latest_sample_time is None:
+        return [], None, None
+
+    start_time = latest_sample_time - time_range
+    times, values = get_field_history(field_parameter)
+    if len(times) == field_history_size and times[0] > start_time:
+        slot_times, slot_values = get_field_slot_history(field_parameter, start_time, times[0])
+        times = slot_times + times
+        values = slot_values + values
+
+    buckets = downsample_min_max(times, values, start_time, latest_sample_time, width)
+    if not buckets:
+        return [], None, None
+
+    minimum = min(bucket_minimum for bucket, bucket_minimum, bucket_maximum in buckets)
+    maximum = max(bucket_maximum for bucket, bucket_minimum, bucket_maximum in buckets)
+    value_range = maximum - minimum if maximum > minimum else 1.0
+
+    # Every bucket is a vertical line from its min to its max (y of the canvas goes down)
+    points = []
+    for bucket, bucket_minimum, bucket_maximum in buckets:
+        points.extend((bucket, height - 1 - (bucket_minimum - minimum) / value_range * (height - 2)))
+        points.extend((bucket, height - 1 - (bucket_maximum - minimum) / value_range * (height - 2)))
+
+    return points, minimum, maximum
+
+
+
+# Function of a decode worker process. It loads the databases once (from the DBC cache) and decodes the batches of frames
+# of its IDs. The field values of a batch go back as one list of (field, value, channel, counter, time), with the number of errors.
+def decode_worker(dbc_filenames, worker_field_message_names, instrumentation_enabled, worker_decode_cache_size, input_queue, result_queue):
+    global decode_cache, decode_cache_size
+
+    field_message_names.update(worker_field_message_names)
+    decode_cache_size = worker_decode_cache_size
+    if decode_cache_size > 0:
+        decode_cache = cachetools.LRUCache(maxsize=decode_cache_size)
+    databases = []
+    database_list(databases, dbc_filenames, [])
+    worker_subscribed_messages = build_subscription_index(databases)
+    worker_message_lookup = build_message_lookup(worker_subscribed_messages)
+    message_decoders.update(compile_message_decoders(worker_subscribed_messages, dbc_filenames))
+
+    while True:
+        batch = input_queue.get()
+        if batch is None:
+            return
+
+        start_time = time.perf_counter()
+        field_updates = []
+        errors = 0
+        # Decode errors are counted in error_counter of this process, the new ones of this batch go to the main process
+        error_counter_start = error_counter
+        for arbitration_id, is_extended_id, data, channel, counter_value, timestamp in batch:
+            try:
+                field_values, unchanged = decode_with_memo(worker_message_lookup, can.Message(arbitration_id=arbitration_id, is_extended_id=is_extended_id, data=data, channel=channel))
+                for field_parameter, current_value in field_values:
+                    field_updates.append((field_parameter, current_value, channel, counter_value, timestamp, unchanged))
+
+            # Error handling
+            except Exception as e:
+                errors += 1
+                print(f'{e}')
+
+        errors += error_counter - error_counter_start
+        decode_time = time.perf_counter() - start_time if instrumentation_enabled else 0.0
+
+        # The memo counters of this batch go to the main process
+        memo_statistics = dict(decode_memo_statistics)
+        for key in decode_memo_statistics:
+            decode_memo_statistics[key] = 0
+
+        result_queue.put((field_updates, errors, decode_time, len(batch), memo_statistics))
+
+
+
+# Function to send the collected frames to their decode workers (called under ingest_lock)
+def send_decode_worker_batches():
+    for worker_queue, batch in zip(decode_worker_queues, decode_worker_batches):
+        if batch:
+            worker_queue.put(batch[:])
+            decode_worker_counters['sent'] += len(batch)
+            batch.clear()
+
+
+
+# Function to store the field values that the decode workers send back. Runs in its own thread.
+def receive_decode_results():
+    global error_counter
+
+    while True:
+        field_updates, errors, decode_time, frames, memo_statistics = decode_result_queue.get()
+
+        with decoded_values_lock:
+            for field_parameter, current_value, channel_value, counter_value, timestamp, unchanged in field_updates:
+                store_field_value(field_parameter, current_value, channel_value, counter_value, timestamp, unchanged)
+
+        for key, value in memo_statistics.items():
+            decode_memo_statistics[key] += value
 
-    if decoded_message is not None:
-        for i, (field_parameter, message_name) in enumerate(zip(field_parameters, message_names_field_parameters), start=1): # Loop over field_parameters in JSON-file
-            if field_parameter in decoded_message and (message_name == name_of_found_message or message_name == ''):
+        if errors:
+            with ingest_lock:
+                error_counter += errors
 
-                current_value = decoded_message.get(field_parameter)
-                value_text_widget = field_value_texts[field_parameter]
-                value_text_widget.config(state="normal")
-                # Get old value
-                old_value = value_text_widget.get("1.0", "end").strip()
-                # Compare old value to current value
+        if Instrumentation.enabled and frames:
+            Instrumentation.record('decode', decode_time / frames, frames)
 
-                if str(current_value) != old_value:
-                    # Update value text in gui
-                    value_text_widget.delete("1.0", "end")
-                    value_text_widget.insert("1.0", str(current_value))
-                    # Call function update_textbox_color
-                    a = field_parameter
-                    update_textbox_color(field_parameter, current_value, *min_max_values.get(field_parameter, (-math.inf, math.inf)))
+        decode_worker_counters['done'] += frames
 
 
-                # Update channel values
-                if field_parameter in channel_textboxes:
-                    channel_textbox = channel_textboxes[field_parameter]
-                    channel_textbox.config(state="normal")
-                    channel_value = message.channel
-                    channel_textbox.config(text=channel_value)
-                    channel_textbox.config(state="disabled")
 
-                value_text_widget.config(state="disabled")
+# Function to wait until the decode workers decoded all frames that were sent to them
+def wait_for_decode_workers(timeout=10.0):
+    end_time = time.perf_counter() + timeout
+    while decode_worker_counters['done'] < decode_worker_counters['sent'] and time.perf_counter() < end_time:
+        time.sleep(0.01)
 
-                if id in dict_recv_msg_cnt:
-                    counter_value = dict_recv_msg_cnt[id]
-                    # Update counter text in gui
-                    counter_labels[field_parameter].config(text=counter_value)
-                    previous_values[field_parameter] = decoded_message[field_parameter]
 
 
-    end_time = time.perf_counter()
-    elapsed_time = end_time - start_time
-    #print('elapsed_time_update_signal_values:', elapsed_time*1000)
+# Function to start number_of_workers decode worker processes and the thread that receives their results
+def start_decode_workers(number_of_workers):
+    global decode_result_queue
+
+    # spawn: the same on Windows and Linux, and no fork of a process that already has threads
+    context = multiprocessing.get_context('spawn')
+    decode_result_queue = context.Queue()
+
+    for worker_index in range(number_of_workers):
+        worker_queue = context.Queue()
+        worker = context.Process(target=decode_worker, args=(loaded_dbc_filenames, field_message_names, Instrumentation.enabled, decode_cache_size, worker_queue, decode_result_queue))
+        worker.daemon = True
+        worker.start()
+
+        decode_workers.append(worker)
+        decode_worker_queues.append(worker_queue)
+        decode_worker_batches.append([])
+
+    result_thread = Thread(target=receive_decode_results)
+    result_thread.daemon = True
+    result_thread.start()
+
+
+
+# Function to stop the decode workers
+def stop_decode_workers():
+    for worker_queue in decode_worker_queues:
+        worker_queue.put(None)
+
+    for worker in decode_workers:
+        worker.join(decode_worker_stop_timeout)
+        if worker.is_alive():
+            worker.terminate()
+
+
+
+# Function to update signal value, colour, channel value and counter of one field in the GUI.
+# The rendered state of every field is remembered, so only widgets with a changed value, colour, counter or channel are touched.
+def update_gui_values(field_parameter, current_value, channel_value, counter_value):
+    #print('\n in function update_gui_values(field_parameter, current_value, channel_value, counter_value)')
+    global status_text, field_value_texts, field_parameters, data, signal_value_counters, counter_labels, previous_values, bus_instances, subscribed_messages, root, error_counter_text, message_names_field_parameters
+
+    if Instrumentation.enabled:
+        start_time = time.perf_counter()
+
+    value_text = str(current_value)
+    colour = 'red' if is_out_of_limits(field_parameter, current_value) else 'white'
+    old_value_text, old_colour, old_channel_value, old_counter_value = rendered_values.get(field_parameter, (None, None, None, None))
+
+    value_text_widget = field_value_texts[field_parameter]
+
+    if value_text != old_value_text:
+        # Update value text in gui
+        value_text_widget.config(state="normal")
+        value_text_widget.delete("1.0", "end")
+        value_text_widget.insert("1.0", value_text)
+        value_text_widget.config(state="disabled")
+
+    if colour != old_colour:
+        # Update textbox color based on min-values and max-values
+        value_text_widget.config(bg=colour)
+
+    # Update channel values
+    if channel_value != old_channel_value and field_parameter in channel_textboxes:
+        channel_textboxes[field_parameter].config(text=channel_value)
+
+    if counter_value is not None and counter_value != old_counter_value:
+        # Update counter text in gui
+        counter_labels[field_parameter].config(text=counter_value)
+
+    rendered_values[field_parameter] = (value_text, colour, channel_value, counter_value)
+    previous_values[field_parameter] = current_value
+
+    if Instrumentation.enabled:
+        Instrumentation.record('render', time.perf_counter() - start_time)
 
 
 
 # Function to update gui based on can status. If there is data: put textbox in green, else put textbox in red.
 def update_can_status(status):
+    if Instrumentation.enabled:
+        start_time = time.perf_counter()
 
-    start_time_update_can_status = time.time()
-    #print('\n \n \n dit is error counter:',error_counter)
-
-    # If there is no data, put textbox in white
+    # If there is no data, put textbox in red
     if status == 'no data':
         status_text.config(bg='red')
-        status_text.delete("1.0", "end")
-        status_text.insert("1.0", "")
-        status_text.config(state="disabled")
 
     # If there is data, put textbox in green
     if status == 'data':
         status_text.config(bg='green')
-        status_text.delete("1.0", "end")
-        status_text.insert("1.0", "")
-        status_text.config(state="disabled")
 
-    end_time_update_can_status = time.time()
-    elapsed_time_update_can_status = end_time_update_can_status - start_time_update_can_status
-    #print('elapsed_time_update_can_status:',elapsed_time_update_can_status)
+    if Instrumentation.enabled:
+        Instrumentation.record('render', time.perf_counter() - start_time)
 
 
 
-# Function to refresh the gui
+# Function to update a label in the status row, only if its text changed
+def update_status_label(label, text):
+    if rendered_status.get(label) != text:
+        label.config(text=text)
+        rendered_status[label] = text
+
+
+
+# Function to refresh the gui. It runs on the tkinter thread and schedules itself again with root.after().
+# The frames are already decoded at receive time, only the fields that changed since the last refresh are rendered.
 def gui_refresh():
     start_time = time.perf_counter()
-    global status_text, field_value_texts, field_parameters, data, signal_value_counters, counter_labels, previous_values, bus_instances, filtered_database, root, error_counter_text, message_names_field_parameters, list_received_messages
+    global status_text, field_value_texts, field_parameters, data, signal_value_counters, counter_labels, previous_values, bus_instances, subscribed_messages, root, error_counter_text, message_names_field_parameters, prev_msg_cnt, constant_msg_cnt_time, channel_report_time, can_status, counter_refresh_time
     #print('Gui is refreshing...')
 
-    prev_msg_cnt = global_msg_cnt
-    constant_msg_cnt_time = 0  # Initialize the timer
+    # Take the fields that changed since the last refresh, and every counter_refresh_interval also the fields with only a new counter
+    counter_refresh_time += time_sleep_gui
+    with decoded_values_lock:
+        changed_fields = list(dirty_fields)
+        dirty_fields.clear()
+        if counter_refresh_time >= counter_refresh_interval:
+            changed_fields.extend(unchanged_fields.difference(changed_fields))
+            unchanged_fields.clear()
+            counter_refresh_time = 0
+
+    for index, field_parameter in enumerate(changed_fields):
+        # Fields that do not fit in the frame budget are rendered in the next refresh
+        if time.perf_counter() - start_time > render_frame_budget:
+            with decoded_values_lock:
+                dirty_fields.update(changed_fields[index:])
+            break
+
+        current_value, channel_value, counter_value = decoded_values[field_parameter]
+        update_gui_values(field_parameter, current_value, channel_value, counter_value)
+
+    update_status_label(error_counter_text, error_counter)
+    update_status_label(ingest_high_water_mark_text, ingest_statistics['high_water_mark'])
+    update_status_label(ingest_dropped_text, ingest_statistics['dropped'])
+    update_status_label(overflow_counter_text, sum(statistics['overflows'] for statistics in channel_statistics.values()))
+
+    # Report the throughput and driver-queue overflows per channel
+    channel_report_time += time_sleep_gui
+    if channel_report_time >= channel_report_interval:
+        print(format_channel_statistics() + ' | ' + format_ingest_statistics() + ' | ' + format_decode_memo_statistics() + ' | ' + ASC_logger.format_log_counters())
+        channel_report_time = 0
+
+    # Put status-box in green if it there is data, otherwise if there is no data for 2 seconds --> put textbox in red
+    if global_msg_cnt == prev_msg_cnt:
+        constant_msg_cnt_time += time_sleep_gui  # Add interval gui_refresh
+
+        if constant_msg_cnt_time >= 2.0 and can_status != 'no data':  # Check if global message count has remained the same for 2 seconds
+            print('global_msg_cnt has remained constant for 2 seconds.')
+            can_status = 'no data'
+            update_can_status(can_status)
+    else:
+        constant_msg_cnt_time = 0  # Reset the timer
+        prev_msg_cnt = global_msg_cnt
+        if can_status != 'data':
+            can_status = 'data'
+            update_can_status(can_status)
+
+    if Instrumentation.enabled:
+        Instrumentation.record('gui refresh', time.perf_counter() - start_time)
 
-    while True:
-        d = list_received_messages
+    root.after(int(time_sleep_gui * 1000), gui_refresh)
 
 
-        for message in list_received_messages:
-            #print('Gui is refreshing-2...')
-            h = list_received_messages
-            if (message.arbitration_id & 0xFF) < 50:
-                decoded, name_of_found_message = decode_can_message(filtered_database, message)
-                update_gui_values(decoded, name_of_found_message, message.arbitration_id, message)
 
-        end_time = time.perf_counter()
-        elapsed_time = end_time - start_time
-        #print('elapsed_gui_refresh:', elapsed_time * 1000)
-        error_counter_text.config(text=error_counter)
+# Function to open the trend view: the history of one field over the last minutes, downsampled to one min/max line per pixel
+def show_trend_panel():
+    import tkinter as tk
+
+    panel = tk.Toplevel(root)
+    panel.title("Trend")
+
+    field_names = list(dict.fromkeys(field_parameters))
+    selected_field = tk.StringVar(panel, value=field_names[0])
+    selected_minutes = tk.IntVar(panel, value=trend_minutes_options[1])
 
-        # Put status-box in green if it there is data, otherwise if there is no data for 2 seconds --> put textbox in red
-        if global_msg_cnt == prev_msg_cnt:
-            constant_msg_cnt_time += time_sleep_gui  # Add interval gui_refresh
+    controls_frame = tk.Frame(panel)
+    controls_frame.pack(fill="x")
+    tk.OptionMenu(controls_frame, selected_field, *field_names).pack(side="left")
+    tk.OptionMenu(controls_frame, selected_minutes, *trend_minutes_options).pack(side="left")
+    tk.Label(controls_frame, text="min").pack(side="left")
 
-            if constant_msg_cnt_time >= 2.0:  # Check if global message count has remained the same for 2 seconds
-                print('global_msg_cnt has remained constant for 2 seconds.')
-                update_can_status('no data')
+    canvas = tk.Canvas(panel, width=trend_width, height=trend_height, bg="white")
+    canvas.pack()
+    trend_line = canvas.create_line(0, 0, 0, 0, fill="blue")
+    maximum_text = canvas.create_text(5, 5, anchor="nw", text="")
+    minimum_text = canvas.create_text(5, trend_height - 5, anchor="sw", text="")
+
+    # Refresh the trend view while it is open
+    def refresh_trend_panel():
+        if not panel.winfo_exists():
+            return
+
+        points, minimum, maximum = get_trend_points(selected_field.get(), selected_minutes.get() * 60, trend_width, trend_height)
+        if len(points) >= 4:
+            canvas.coords(trend_line, *points)
         else:
-            constant_msg_cnt_time = 0  # Reset the timer
-            prev_msg_cnt = global_msg_cnt
-            update_can_status('data')
+            canvas.coords(trend_line, 0, 0, 0, 0)
+        canvas.itemconfig(maximum_text, text="" if maximum is None else f"max {maximum:g}")
+        canvas.itemconfig(minimum_text, text="" if minimum is None else f"min {minimum:g}")
 
-        time.sleep(time_sleep_gui)
+        panel.after(trend_refresh_interval, refresh_trend_panel)
+
+    refresh_trend_panel()
+
+
+
+# Function to open the panel with the counters and latency histograms of the instrumentation
+def show_instrumentation_panel():
+    import tkinter as tk
+
+    panel = tk.Toplevel(root)
+    panel.title("Instrumentation")
+    report_text = tk.Text(panel, height=len(Instrumentation.stage_names) + 2, width=80, font=("Courier", 10))
+    report_text.pack(fill="both", expand=True)
+
+    # Refresh the panel while it is open
+    def refresh_instrumentation_panel():
+        if not panel.winfo_exists():
+            return
+        report_text.config(state="normal")
+        report_text.delete("1.0", "end")
+        report_text.insert("1.0", Instrumentation.format_report())
+        report_text.config(state="disabled")
+        panel.after(instrumentation_refresh_interval, refresh_instrumentation_panel)
+
+    refresh_instrumentation_panel()
 
 
 
@@ -670,32 +1654,165 @@ def create_log_file_path():
 
 
 
+# Function to check the limits of the fields that changed, without GUI.
+# Fields that go out of their limits or come back within their limits are reported.
+def check_changed_fields():
+    with decoded_values_lock:
+        changed_fields = list(dirty_fields)
+        dirty_fields.clear()
+
+    limit_reports = []
+    for field_parameter in changed_fields:
+        current_value, channel_value, counter_value = decoded_values[field_parameter]
+        out_of_limits = is_out_of_limits(field_parameter, current_value)
+
+        if out_of_limits != fields_out_of_limits.get(field_parameter, False):
+            fields_out_of_limits[field_parameter] = out_of_limits
+            state = 'out of limits' if out_of_limits else 'within limits'
+            limit_reports.append(f'{field_parameter} {state}: {current_value} (min {min_max_values[field_parameter][0]}, max {min_max_values[field_parameter][1]}, ch {channel_value})')
+
+        previous_values[field_parameter] = current_value
+
+    return limit_reports
+
+
+
+# Function to make the status report of the headless mode
+def format_status():
+    fields_with_value = sum(value is not None for value in previous_values.values())
+    out_of_limits = [field_parameter for field_parameter, state in fields_out_of_limits.items() if state]
+
+    return (f'{datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")} | messages: {global_msg_cnt} | errors: {error_counter} | '
+            f'fields: {fields_with_value}/{len(field_parameters)} | out of limits: {", ".join(out_of_limits) or "-"} | '
+            f'{format_channel_statistics()} | {format_ingest_statistics()} | {format_decode_memo_statistics()} | {ASC_logger.format_log_counters()}')
+
+
+
+# Function to run without GUI: check the limits of changed fields and write the status every status_interval seconds,
+# to stdout or (overwritten) to status_file_path. Returns when the replay thread is finished.
+def run_headless(status_file_path, status_interval, replay_thread=None):
+    next_status_time = time.perf_counter() + status_interval
+
+    while True:
+        time.sleep(time_sleep_gui)
+
+        # At the end of the replay, the decode workers first finish their frames
+        replay_finished = replay_thread is not None and not replay_thread.is_alive()
+        if replay_finished:
+            wait_for_decode_workers()
+
+        for limit_report in check_changed_fields():
+            print(limit_report)
+
+        if time.perf_counter() >= next_status_time or replay_finished:
+            next_status_time += status_interval
+            status = format_status()
+
+            if Instrumentation.enabled:
+                status += '\n' + Instrumentation.format_report()
+
+            if status_file_path is None:
+                print(status)
+            else:
+                with open(status_file_path, 'w') as status_file:
+                    status_file.write(status + '\n')
+
+        if replay_finished:
+            return
+
+
+
 # If program exits, end the logger file
 def exit_handler():
+    # Write the messages that are still in the queue of the log writer
+    ASC_logger.stop_log_writer()
+    stop_decode_workers()
+
     if log_file is not None and not log_file.closed:
         log_file.write("End TriggerBlock\n")
         log_file.close()
 
+    # Write the instrumentation report
+    if Instrumentation.enabled and instrumentation_file_path is not None:
+        Instrumentation.dump_report(instrumentation_file_path)
+
 
 
 # Main function
 def main():
+    global instrumentation_file_path, ingest_policy, ingest_buffer_size, field_history_size, decode_cache_size
+
+    # Command line arguments
+    parser = argparse.ArgumentParser(description="Show the decoded signals of CAN-messages received through CAN-interface or replayed from a log file.")
+    parser.add_argument("--replay", metavar="LOG_FILE", help="replay a .asc log file instead of receiving from the CAN-interfaces")
+    parser.add_argument("--speed", type=float, default=1.0, help="replay speed as factor on real time, 0 replays as fast as possible (default: 1.0)")
+    parser.add_argument("--full-log", action="store_true", help="log all messages on the bus, not only the messages that pass the acceptance filters")
+    parser.add_argument("--config", metavar="JSON_FILE", help="JSON configuration file (default: choose in folder 'Configuration files')")
+    parser.add_argument("--headless", action="store_true", help="run without GUI (tkinter is not imported), needs --config")
+    parser.add_argument("--status-file", metavar="FILE", help="headless: write the status to this file instead of stdout")
+    parser.add_argument("--status-interval", type=float, default=5.0, help="headless: seconds between status reports (default: 5.0)")
+    parser.add_argument("--ingest-policy", choices=ingest_policies, default=ingest_policy, help="if the ingest buffer is full: block the receive thread, drop the oldest message or replace the waiting message of the same ID (default: block)")
+    parser.add_argument("--ingest-size", type=int, default=ingest_buffer_size, help=f"maximum number of received messages waiting to be processed (default: {ingest_buffer_size})")
+    parser.add_argument("--decode-workers", type=int, default=0, help="decode in this many worker processes, frames are divided by ID (default: 0, decode in the processing thread)")
+    parser.add_argument("--decode-cache-size", type=int, default=decode_cache_size, help="LRU cache of this many decoded (ID, payload) pairs, for IDs that send a few payloads in turn (default: 0, off)")
+    parser.add_argument("--history-size", type=int, default=field_history_size, help=f"samples kept per field for the trend view, 16 bytes each; older samples are kept as min/max per second (default: {field_history_size})")
+    parser.add_argument("--instrument", action="store_true", help="measure counters and latency histograms of receive, decode, limit check, log write and render")
+    parser.add_argument("--instrument-file", metavar="JSON_FILE", help="write the instrumentation report to this file on exit (switches on --instrument)")
+    arguments = parser.parse_args()
+
+    if arguments.speed < 0:
+        parser.error("--speed must be 0 or positive")
+    if arguments.headless and arguments.config is None:
+        parser.error("--headless needs --config")
+    if arguments.ingest_size < 1:
+        parser.error("--ingest-size must be at least 1")
+    if arguments.decode_workers < 0:
+        parser.error("--decode-workers must be 0 or positive")
+    if arguments.decode_cache_size < 0:
+        parser.error("--decode-cache-size must be 0 or positive")
+    if arguments.history_size < 1:
+        parser.error("--history-size must be at least 1")
+
+    ingest_policy = arguments.ingest_policy
+    ingest_buffer_size = arguments.ingest_size
+    field_history_size = arguments.history_size
+    decode_cache_size = arguments.decode_cache_size
+
+    # Switch on the instrumentation before the threads start
+    if arguments.instrument or arguments.instrument_file:
+        Instrumentation.enable()
+        instrumentation_file_path = arguments.instrument_file
 
     # Call function init()
-    init()
+    init(arguments.replay, arguments.full_log, arguments.config, arguments.headless)
 
-    # Multithreading
-    can_thread = Thread(target=receive_and_process_can_data)
-    can_thread.daemon = True
-    can_thread.start()
+    # Start the decode worker processes (optional)
+    if arguments.decode_workers > 0:
+        start_decode_workers(arguments.decode_workers)
 
-    gui_thread = Thread(target=gui_refresh)
-    gui_thread.daemon = True
-    gui_thread.start()
+    # Multithreading: one receive thread per bus, or one thread that replays the log file
+    replay_thread = None
+    if arguments.replay:
+        replay_thread = start_replay_thread(arguments.replay, arguments.speed)
+    else:
+        start_receive_threads()
 
     # Register the exit handler
     atexit.register(exit_handler)
 
+    if arguments.headless:
+        # Stop like with Ctrl+C when the service is stopped, so the exit handler still ends the logger file
+        signal.signal(signal.SIGTERM, lambda signal_number, frame: sys.exit(0))
+
+        try:
+            run_headless(arguments.status_file, arguments.status_interval, replay_thread)
+        except KeyboardInterrupt:
+            pass
+        return
+
+    # Call function gui_refresh(), it schedules itself on the tkinter thread
+    gui_refresh()
+
     root.mainloop()
 
 
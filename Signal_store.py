@@ -0,0 +1,243 @@
+"""
+Author: Jens Segaert
+Company: VDL Bus Roeselare
+
+Python version: 3.11.5
+
+Description: Converts an ASC log file to a columnar store of the signals in Field_parameters, decoded with the DBC files of the
+JSON configuration (the same selection as Main). The store is a folder next to the log (can_log_....asc.signals) with per field
+three raw column files: time (float64, seconds in the log), value (float64) and channel (uint8).
+Converting again after the log has grown only decodes the new part. Loading uses memory-mapped NumPy arrays, so it is near-instant.
+The frames are decoded per message in batches (see Batch_decoder), with the same results as cantools.
+
+Convert: python Signal_store.py "Log files\\can_log_....asc" --config "Configuration files\\vector__2channels\\....json"
+Load:    columns = Signal_store.load_signal_store("Log files\\can_log_....asc"); times, values, channels = columns['AmbientAirTemp']
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import shutil
+
+import numpy
+import Batch_decoder
+import Main
+
+
+
+store_version = 1
+store_suffix = '.signals'
+state_file_name = 'state.json'
+read_block_size = 16 * 1024 * 1024  # Bytes of the log that are read and decoded at once
+column_types = (('time', numpy.float64), ('value', numpy.float64), ('channel', numpy.uint8))
+
+
+
+# Function to get the folder of the signal store of a log file
+def get_store_path(log_path):
+    return log_path + store_suffix
+
+
+
+# Function to get the path of a column file of a field
+def get_column_path(store_path, field_parameter, column_name):
+    return os.path.join(store_path, f'{field_parameter}.{column_name}')
+
+
+
+# Function to load the decoder of a JSON configuration, like Main: the DBC files, the fields and the lookup of the subscribed messages.
+# Returns the lookup, the field names and a hash of the configuration (fields and DBC files); if the hash changes, the store is made again.
+def load_decoder(config_file_path):
+    data = Main.load_json(config_file_path)
+
+    dbc_filenames = [data.get(f"Locatie Database CAN{i}") for i in range(1, 20) if data.get(f"Locatie Database CAN{i}")]
+    databases = []
+    dbc_file_list, databases = Main.database_list(databases, dbc_filenames, [])
+
+    field_parameters = [field_data[f"Field{i}"]["value"] for i, field_data in enumerate(data.get("Field_parameters"), start=1)]
+    message_names_field_parameters = [field_data[f"Field{i}"]["message"] for i, field_data in enumerate(data.get("Field_parameters"), start=1)]
+    Main.field_message_names.clear()
+    for field_parameter, message_name in zip(field_parameters, message_names_field_parameters):
+        Main.field_message_names.setdefault(field_parameter, set()).add(message_name)
+
+    message_lookup = Main.build_message_lookup(Main.build_subscription_index(databases))
+
+    config_hash = hashlib.sha256(json.dumps({
+        'fields': sorted((field_parameter, sorted(message_names)) for field_parameter, message_names in Main.field_message_names.items()),
+        'dbc_files': [Main.get_dbc_cache_key(dbc_filename) for dbc_filename in dbc_file_list]
+    }).encode('utf-8')).hexdigest()
+
+    return message_lookup, list(dict.fromkeys(field_parameters)), config_hash
+
+
+
+# Function to read a frame line of an ASC log, e.g. b'   0.024188 1  18FFB331x       Rx   d 8 81 22 22 00 1E 00 00 00'.
+# Returns (timestamp, channel as in the log (starting at 1), arbitration ID, data) or None for other lines.
+def parse_frame_line(line):
+    fields = line.split()
+    if len(fields) < 6 or not fields[1].isdigit() or fields[3] not in (b'Rx', b'Tx') or fields[4] != b'd':
+        return None
+
+    try:
+        dlc = int(fields[5], 16)
+        return float(fields[0]), int(fields[1]), int(fields[2].rstrip(b'xX'), 16), bytes.fromhex(b' '.join(fields[6:6 + dlc]).decode('ascii'))
+    except ValueError:
+        return None
+
+
+
+# Function to read the state of a store (None if there is no valid store)
+def read_state(store_path):
+    try:
+        with open(os.path.join(store_path, state_file_name), 'r') as state_file:
+            state = json.load(state_file)
+    except (OSError, ValueError):
+        return None
+
+    return state if state.get('version') == store_version else None
+
+
+
+# Function to write the state of a store. A temporary file is written first, so an interrupted write never leaves a broken state.
+def write_state(store_path, state):
+    state_path = os.path.join(store_path, state_file_name)
+    with open(state_path + '.tmp', 'w') as state_file:
+        json.dump(state, state_file, indent=1)
+    os.replace(state_path + '.tmp', state_path)
+
+
+
+# Function to decode the frames of a block of log lines. The frames are grouped per arbitration ID and data length and every
+# group is decoded at once by Batch_decoder. Returns per field the (times, values, channels) arrays, in order of the log.
+def decode_lines(lines, message_lookup):
+    frame_groups = {}
+    for line_number, line in enumerate(lines):
+        frame = parse_frame_line(line)
+
+        # Same selection as Main: only source addresses below 50 are decoded
+        if frame is None or (frame[2] & 0xFF) >= 50:
+            continue
+
+        timestamp, channel, arbitration_id, data = frame
+        frame_groups.setdefault((arbitration_id, len(data)), []).append((line_number, timestamp, channel, data))
+
+    field_parts = {}
+    for (arbitration_id, data_length), frames in frame_groups.items():
+        db, found_message = Main.find_message(message_lookup, arbitration_id)
+
+        # Frames that are shorter than the message can not be decoded (cantools raises an error, Main skips them)
+        if found_message is None or data_length < found_message.length:
+            continue
+
+        line_numbers, times, channels, payloads = zip(*frames)
+        payloads = numpy.frombuffer(b''.join(payloads), dtype=numpy.uint8).reshape(len(frames), data_length)
+        valid, signal_values = Batch_decoder.decode_batch(found_message, payloads)
+
+        for field_parameter, current_value in Main.get_field_values(dict.fromkeys(signal_values), found_message.name):
+            values, present = signal_values[field_parameter]
+            field_parts.setdefault(field_parameter, []).append((numpy.array(line_numbers)[present], numpy.array(times)[present],
+                                                                 numpy.asarray(values)[present], numpy.array(channels)[present]))
+
+    # Per field, the parts of all messages are put in order of the log
+    columns = {}
+    for field_parameter, parts in field_parts.items():
+        line_numbers, times, values, channels = (numpy.concatenate(column_parts) for column_parts in zip(*parts))
+        order = numpy.argsort(line_numbers, kind='stable')
+        columns[field_parameter] = (times[order], values[order], channels[order])
+
+    return columns
+
+
+
+# Function to convert a log file (or only its new part) to the signal store. Returns the state of the store.
+def convert_log(log_path, config_file_path):
+    store_path = get_store_path(log_path)
+    message_lookup, field_parameters, config_hash = load_decoder(config_file_path)
+    log_size = os.path.getsize(log_path)
+
+    # A store of another configuration, or of a log that is now smaller (another file), is made again
+    state = read_state(store_path)
+    if state is None or state['config_hash'] != config_hash or state['log_size'] > log_size:
+        shutil.rmtree(store_path, ignore_errors=True)
+        os.makedirs(store_path)
+        state = {'version': store_version, 'config_hash': config_hash, 'config_file': os.path.abspath(config_file_path),
+                 'log_size': 0, 'counts': {field_parameter: 0 for field_parameter in field_parameters}}
+
+    # Column files can have rows of an interrupted conversion after the counts in the state: these are removed
+    for field_parameter, count in state['counts'].items():
+        for column_name, numpy_type in column_types:
+            with open(get_column_path(store_path, field_parameter, column_name), 'ab') as column_file:
+                column_file.truncate(count * numpy.dtype(numpy_type).itemsize)
+
+    with open(log_path, 'rb') as log_file:
+        log_file.seek(state['log_size'])
+
+        while True:
+            block = log_file.read(read_block_size)
+
+            # Only complete lines are decoded, the rest is read again next time
+            block_end = block.rfind(b'\n') + 1
+            if block_end == 0:
+                break
+
+            columns = decode_lines(block[:block_end].splitlines(), message_lookup)
+
+            for field_parameter, field_columns in columns.items():
+                for (column_name, numpy_type), column in zip(column_types, field_columns):
+                    with open(get_column_path(store_path, field_parameter, column_name), 'ab') as column_file:
+                        column.astype(numpy_type).tofile(column_file)
+                state['counts'][field_parameter] += len(field_columns[0])
+
+            state['log_size'] += block_end
+            log_file.seek(state['log_size'])
+            write_state(store_path, state)
+
+    return state
+
+
+
+# Function to load the signal store of a log file: per field (times, values, channels) as memory-mapped NumPy arrays
+def load_signal_store(log_path):
+    store_path = get_store_path(log_path)
+    state = read_state(store_path)
+    if state is None:
+        return None
+
+    signal_columns = {}
+    for field_parameter, count in state['counts'].items():
+        field_columns = []
+        for column_name, numpy_type in column_types:
+            if count == 0:
+                field_columns.append(numpy.empty(0, dtype=numpy_type))
+            else:
+                field_columns.append(numpy.memmap(get_column_path(store_path, field_parameter, column_name), dtype=numpy_type, mode='r', shape=(count,)))
+        signal_columns[field_parameter] = tuple(field_columns)
+
+    return signal_columns
+
+
+
+# Main function
+def main():
+    parser = argparse.ArgumentParser(description="Convert ASC log files to a columnar store of the signals in Field_parameters.")
+    parser.add_argument("log_files", nargs="+", help="ASC log files")
+    parser.add_argument("--config", help="JSON configuration with the DBC files and Field_parameters (default: the configuration of the existing store)")
+    arguments = parser.parse_args()
+
+    for log_path in arguments.log_files:
+        config_file_path = arguments.config
+        if config_file_path is None:
+            state = read_state(get_store_path(log_path))
+            if state is None:
+                parser.error(f"{log_path} has no signal store yet, --config is needed")
+            config_file_path = state['config_file']
+
+        state = convert_log(log_path, config_file_path)
+        print(f'{get_store_path(log_path)}: {sum(state["counts"].values())} values of {sum(count > 0 for count in state["counts"].values())} fields, '
+              f'{state["log_size"]} bytes of the log')
+
+
+
+if __name__ == "__main__":
+    main()